@@ -1,27 +1,57 @@
 import datetime
 import pathlib
+import shutil
+import subprocess
+from concurrent.futures import as_completed
 from typing import Annotated, TypedDict
 
 import moviepy.editor as mp
 import rich
 import typer
 from loguru import logger
+from PIL import __version__ as pil_version
+from PIL import features as pil_features
 from PIL.Image import open as image_open
 
 from crt_tv.config import Config
-from crt_tv.fs_observer import observe_and_action_fs_events
+from crt_tv.fs_observer import DEBOUNCE_SECONDS, observe_and_action_fs_events
 from crt_tv.images import process_single_image
 from crt_tv.logging import configure_logging
+from crt_tv.manifest import is_manifest_up_to_date, write_manifest
+from crt_tv.ocr_cache import OCR_CACHE_FILENAME
+from crt_tv.profiling import (
+    add_stage_durations,
+    format_stage_durations,
+    pop_stage_durations,
+    start_profiler,
+    stop_profiler,
+)
 from crt_tv.timestamp import (
     get_images_timestamp_font,
-    parse_timestamp_from_image,
+    parse_timestamp_from_region,
     parse_timestamp_from_video,
+    read_exif_timestamp,
+    read_timestamp_region,
+)
+from crt_tv.utils import (
+    forget_created_output_dirs,
+    is_output_up_to_date,
+    iter_source_files,
 )
 from crt_tv.video import process_single_video
+from crt_tv.workers import (
+    create_process_pool,
+    get_num_workers,
+    process_image_batches_in_worker,
+    process_video_in_worker,
+    split_into_tasks,
+)
 
 
 class CLIState(TypedDict):
     verbose: bool
+    profile: bool
+    config_file: pathlib.Path
     config: Config
 
 
@@ -33,12 +63,15 @@ app = typer.Typer(
 
 cli_state: CLIState = {
     "verbose": False,
+    "profile": False,
+    "config_file": None,  # type: ignore[typeddict-item]
     "config": None,  # type: ignore[typeddict-item]
 }
 
 
 @app.callback()
 def main(
+    ctx: typer.Context,
     config_file: Annotated[
         pathlib.Path,
         typer.Option(
@@ -57,12 +90,30 @@ def main(
             is_eager=True,
         ),
     ] = False,
+    profile_output_file: Annotated[
+        pathlib.Path | None,
+        typer.Option(
+            "--profile",
+            help="Record a py-spy profile of the command (including the worker processes) to this file "
+            "and log the time spent in each processing stage",
+        ),
+    ] = None,
 ) -> None:
     if verbose:
         cli_state["verbose"] = True
 
     configure_logging(stdout_level="DEBUG" if verbose else "INFO")
 
+    if profile_output_file is not None:
+        cli_state["profile"] = True
+
+        try:
+            profiler = start_profiler(profile_output_file)
+        except RuntimeError as exc:
+            raise typer.BadParameter(f"--profile: {exc}") from exc
+
+        ctx.call_on_close(lambda: stop_profiler(profiler))
+
     if not config_file.is_absolute():
         raise typer.BadParameter(
             f"--config-file: {config_file} is not an absolute path"
@@ -77,6 +128,7 @@ def main(
         )
 
     logger.info(f"Loading configuration from {config_file}")
+    cli_state["config_file"] = config_file
     cli_state["config"] = Config.load_from_file(config_file)
 
 
@@ -88,10 +140,31 @@ def process(
             help="A file or directory to process, if not set all files in the source directory will be processed"
         ),
     ] = None,
+    force: Annotated[
+        bool,
+        typer.Option(
+            "--force",
+            help="Process all files even if their output is up to date, "
+            "when processing the whole source directory the output directory is emptied first",
+        ),
+    ] = False,
 ) -> None:
     """Resize images and videos in the source directory to the specified aspect ratio and optionally add a timestamp"""
 
     config = cli_state["config"]
+
+    if file_path is not None:
+        # The configured directories are resolved when the config is loaded and the output paths are
+        # built by stripping the source directory from the start of the paths, so resolve the given
+        # path the same way (it may be relative or go through a symlink)
+        file_path = file_path.resolve()
+
+        if not file_path.is_relative_to(config.source_files_dir):
+            logger.error(
+                f"{file_path} is not in the source files directory {config.source_files_dir}"
+            )
+            raise typer.Exit(code=1)
+
     timestamp_font = get_images_timestamp_font(config)
 
     if file_path is None:
@@ -99,6 +172,15 @@ def process(
     elif file_path.is_dir():
         source_files_dir = file_path
     elif file_path.is_file():
+        force = force or config.force_regenerate
+
+        if not force and is_output_up_to_date(file_path, config):
+            logger.info(
+                f"Output of {file_path.name} is newer than the file itself, skipping, "
+                "use --force to process it anyway"
+            )
+            return
+
         if file_path.suffix.lower() == ".jpg":
             process_single_image(file_path, config, timestamp_font)
         elif file_path.suffix.lower() == ".avi":
@@ -118,36 +200,131 @@ def process(
         f"Resizing files in {config.source_files_dir} to {config.aspect_ratio} aspect ratio "
         f"using {config.resize_method} method"
     )
+    logger.debug(
+        f"Using {'Pillow-SIMD' if _is_pillow_simd() else 'Pillow'} {pil_version}"
+    )
+
+    force = force or config.force_regenerate
+    is_processing_whole_source_dir = source_files_dir == config.source_files_dir
+
+    if force and is_processing_whole_source_dir:
+        logger.info(
+            f"Regenerating all files, removing the contents of {config.output_files_dir}"
+        )
+        _remove_output_files(config.output_files_dir)
+        forget_created_output_dirs()
+        config.output_files_dir.mkdir(parents=True, exist_ok=True)
+    elif not force and not is_manifest_up_to_date(config):
+        logger.info(
+            "The settings have changed since the files were last processed, regenerating all files"
+        )
+        force = True
 
     processed_images_count = 0
     processed_videos_count = 0
+    skipped_files_count = 0
+    failed_files_count = 0
+    image_paths: list[pathlib.Path] = []
+    video_paths: list[pathlib.Path] = []
 
-    for file_path in source_files_dir.glob("**/*"):
-        if file_path.is_dir():
-            continue
+    for source_file in iter_source_files(source_files_dir):
+        # Only build a Path for the files which are going to be processed
+        lowercase_file_name = source_file.name.lower()
 
-        if file_path.name.startswith("."):
+        if not lowercase_file_name.endswith((".jpg", ".avi")):
+            logger.warning(
+                f"File {source_file.name} is not a supported format, suffix must be .jpg or .avi, skipping"
+            )
             continue
 
-        relative_file_path = file_path.relative_to(config.source_files_dir)
-        output_file_path = config.output_files_dir / relative_file_path
-        output_file_path.parent.mkdir(parents=True, exist_ok=True)
+        file_path = pathlib.Path(source_file.path)
 
-        if file_path.suffix.lower() == ".jpg":
-            process_single_image(file_path, config, timestamp_font)
-            processed_images_count += 1
-        elif file_path.suffix.lower() == ".avi":
-            process_single_video(file_path, config)
-            processed_videos_count += 1
-        else:
-            logger.warning(
-                f"File {file_path.name} is not a supported format, suffix must be .jpg or .avi, skipping"
+        if not force and is_output_up_to_date(file_path, config):
+            logger.debug(
+                f"Output of {file_path.name} is newer than the file itself, skipping"
             )
+            skipped_files_count += 1
+            continue
+
+        if lowercase_file_name.endswith(".jpg"):
+            image_paths.append(file_path)
+        else:
+            video_paths.append(file_path)
+
+    logger.info(
+        f"Processing {len(image_paths)} images and {len(video_paths)} videos "
+        f"using {get_num_workers(config)} worker processes"
+    )
+
+    with create_process_pool(config, timestamp_font) as pool:
+        # The videos take a lot longer than the batches of images, so they're submitted first
+        # to keep them from being the last thing the other workers are waiting on
+        video_futures = {
+            pool.submit(process_video_in_worker, video_path): video_path
+            for video_path in video_paths
+        }
+        futures = {
+            pool.submit(process_image_batches_in_worker, image_path_batches): [
+                image_path
+                for image_paths_batch in image_path_batches
+                for image_path in image_paths_batch
+            ]
+            for image_path_batches in split_into_tasks(image_paths, config)
+        }
+
+        for future in as_completed([*video_futures, *futures]):
+            if future in video_futures:
+                video_path = video_futures[future]
+
+                try:
+                    _, stage_durations_ns = future.result()
+                except Exception:
+                    logger.exception(f"Error processing video {video_path}")
+                    failed_files_count += 1
+                    continue
+
+                add_stage_durations(stage_durations_ns)
+                processed_videos_count += 1
+                logger.info(
+                    f"Processed {processed_videos_count}/{len(video_paths)} videos"
+                )
+                continue
+
+            task_image_paths = futures[future]
+
+            try:
+                output_image_paths, stage_durations_ns = future.result()
+            except Exception:
+                logger.exception(
+                    f"Error processing a batch of {len(task_image_paths)} images starting with {task_image_paths[0]}"
+                )
+                failed_files_count += len(task_image_paths)
+                continue
+
+            add_stage_durations(stage_durations_ns)
+            # The images which couldn't be read or saved are skipped (and logged) by the worker
+            processed_images_count += len(output_image_paths)
+            failed_files_count += len(task_image_paths) - len(output_image_paths)
+            logger.info(f"Processed {processed_images_count}/{len(image_paths)} images")
+
+    if is_processing_whole_source_dir:
+        write_manifest(config)
+
+    logger.log(
+        "INFO" if cli_state["profile"] else "DEBUG",
+        f"Time spent in each stage: {format_stage_durations(pop_stage_durations())}",
+    )
 
     logger.info(
-        f"Processed {processed_images_count} images and {processed_videos_count} videos"
+        f"Processed {processed_images_count} images and {processed_videos_count} videos, "
+        f"skipped {skipped_files_count} files which were already up to date"
     )
 
+    if failed_files_count:
+        logger.warning(
+            f"Failed to process {failed_files_count} files, see the errors above"
+        )
+
 
 @app.command()
 def get_timestamp(file: pathlib.Path) -> None:
@@ -161,10 +338,18 @@ def get_timestamp(file: pathlib.Path) -> None:
     if file.suffix.lower() == ".jpg":
         logger.info(f"File {file.name} is an image")
 
-        with image_open(file) as img:
+        if config.images.timestamp.use_exif:
+            with image_open(file) as img:
+                extracted_timestamp = read_exif_timestamp(img)
+
+        if extracted_timestamp is not None:
+            logger.info("Using the DateTimeOriginal EXIF tag of the image")
+        else:
+            timestamp_region = read_timestamp_region(file, config)
+
             try:
-                extracted_timestamp = parse_timestamp_from_image(
-                    img, config, failed_timestamp_filename=file.name
+                extracted_timestamp = parse_timestamp_from_region(
+                    timestamp_region, config, failed_timestamp_filename=file.name
                 )
             except ValueError:
                 logger.warning(f"No timestamp found in {file.name}")
@@ -176,7 +361,7 @@ def get_timestamp(file: pathlib.Path) -> None:
     elif file.suffix.lower() == ".avi":
         logger.info(f"File {file.name} is a video")
 
-        with mp.VideoFileClip(str(file.resolve())) as video:
+        with mp.VideoFileClip(str(file)) as video:
             extracted_timestamp = parse_timestamp_from_video(
                 video, config, video_file_path=file
             )
@@ -197,7 +382,20 @@ def run_observer(
     ] = True,
     sleep_time: Annotated[
         float, typer.Option(help="How often (in seconds) to check for fs events")
-    ] = 0.1,
+    ] = 1,
+    debounce_time: Annotated[
+        float,
+        typer.Option(
+            help="How long (in seconds) to wait after the last event for a file before processing it"
+        ),
+    ] = DEBOUNCE_SECONDS,
+    polling: Annotated[
+        bool,
+        typer.Option(
+            help="Poll the source directory for changes instead of relying on the native fs events "
+            "(network file systems are detected and polled automatically on Linux)"
+        ),
+    ] = False,
 ) -> None:
     """Run the file system observer to automatically process images from the source directory"""
 
@@ -205,7 +403,14 @@ def run_observer(
 
     logger.info(f"Running file system observer for {config.source_files_dir}")
 
-    observe_and_action_fs_events(config, recursive=recursive, sleep_time=sleep_time)
+    observe_and_action_fs_events(
+        config,
+        config_file=cli_state["config_file"],
+        recursive=recursive,
+        sleep_time=sleep_time,
+        debounce_time=debounce_time,
+        polling=polling,
+    )
 
 
 @app.command()
@@ -221,6 +426,16 @@ def healthcheck():
         rich.print("❌ (not found)")
         success = False
 
+    video_codec = cli_state["config"].videos.video_codec
+    rich.print(
+        f"[MoviePy] checking if ffmpeg supports the {video_codec} encoder... ", end=""
+    )
+    if _is_ffmpeg_encoder_available(FFMPEG_BINARY, video_codec):
+        rich.print("✅")
+    else:
+        rich.print("❌ (not available, set videos.video_codec to a supported encoder)")
+        success = False
+
     rich.print(
         f"[MoviePy] checking ImageMagick binary at {IMAGEMAGICK_BINARY}... ", end=""
     )
@@ -230,4 +445,54 @@ def healthcheck():
         rich.print("❌ (not found)")
         success = False
 
+    rich.print(
+        "[Pillow] checking if JPEG support is provided by libjpeg-turbo... ", end=""
+    )
+    if pil_features.check_feature("libjpeg_turbo"):
+        rich.print("✅")
+    else:
+        rich.print("⚠️ (not available, JPEG decoding and encoding will be slower)")
+
+    rich.print("[Pillow] checking if Pillow-SIMD is installed... ", end="")
+    if _is_pillow_simd():
+        rich.print("✅")
+    else:
+        rich.print("⚠️ (not installed, resizing will be slower on x86 machines)")
+
     raise typer.Exit(code=0 if success else 1)
+
+
+def _remove_output_files(output_files_dir: pathlib.Path) -> None:
+    # The OCR cache (and its WAL files) are kept, the texts extracted from the same
+    # regions are still valid and re-running OCR on the whole library takes the longest
+    if not output_files_dir.exists():
+        return
+
+    for output_path in output_files_dir.iterdir():
+        if output_path.name.startswith(OCR_CACHE_FILENAME):
+            continue
+
+        if output_path.is_dir() and not output_path.is_symlink():
+            shutil.rmtree(output_path)
+        else:
+            output_path.unlink()
+
+
+def _is_pillow_simd() -> bool:
+    # Pillow-SIMD keeps the Pillow version it's based on and marks its own releases with a .postN suffix
+    return ".post" in pil_version
+
+
+def _is_ffmpeg_encoder_available(ffmpeg_binary: str, encoder: str) -> bool:
+    try:
+        encoders_output = subprocess.run(
+            [ffmpeg_binary, "-hide_banner", "-encoders"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+    # Each encoder is listed as e.g. " V....D libx264              libx264 H.264 / ..."
+    return any(line.split()[1:2] == [encoder] for line in encoders_output.splitlines())
@@ -1,6 +1,14 @@
+import errno
+import itertools
+import os
 import pathlib
+import queue
 import shutil
+import threading
 import time
+from collections import OrderedDict
+from collections.abc import Callable
+from typing import NamedTuple
 
 from loguru import logger
 from watchdog.events import (
@@ -8,20 +16,56 @@ from watchdog.events import (
     FileDeletedEvent,
     FileModifiedEvent,
     FileMovedEvent,
+    FileSystemEvent,
+    FileSystemEventHandler,
     PatternMatchingEventHandler,
 )
+from watchdog.observers import Observer
+from watchdog.observers.api import BaseObserver
 from watchdog.observers.polling import PollingObserver
 
 from crt_tv import kodi
 from crt_tv.config import Config
 from crt_tv.images import process_single_image
 from crt_tv.timestamp import get_images_timestamp_font
-from crt_tv.utils import get_output_path
+from crt_tv.utils import get_output_path, is_output_up_to_date
 from crt_tv.video import process_single_video
+from crt_tv.workers import get_num_workers
+
+# How long to wait after the last event for a file before processing it, copying a file
+# usually generates a burst of created/modified events which should only be processed once
+DEBOUNCE_SECONDS = 0.5
+
+# A file is considered fully written once its size stays the same for this long
+SIZE_STABILITY_INTERVAL_SECONDS = 0.2
+
+NETWORK_FILE_SYSTEM_TYPES = frozenset(
+    {"nfs", "nfs4", "cifs", "smb3", "smbfs", "fuse.sshfs"}
+)
+
+# The slideshow is refreshed once this long after the last file of a burst was processed, instead
+# of after every single file which restarts the slideshow as many times
+SLIDESHOW_REFRESH_DELAY_SECONDS = 0.5
+
+# For how many of the files with the latest events their mtime and size are remembered
+MAX_RECENT_EVENTS = 512
+
+# When this many operations are waiting for a worker thread the observer thread blocks
+# until one of them is done rather than queueing up the events of a huge import
+MAX_QUEUED_OPERATIONS = 1024
+
+
+class _FileOperation(NamedTuple):
+    operation_id: int
+    file_path: pathlib.Path
+    action: Callable[..., None]
+    args: tuple[pathlib.Path, ...]
 
 
 class RetrosnapFileHandler(PatternMatchingEventHandler):
-    def __init__(self, config: Config) -> None:
+    def __init__(
+        self, config: Config, *, debounce_seconds: float = DEBOUNCE_SECONDS
+    ) -> None:
         super().__init__(
             patterns=["*.jpg", "*.avi"],
             ignore_directories=True,
@@ -29,21 +73,177 @@ class RetrosnapFileHandler(PatternMatchingEventHandler):
         )
         self.config = config
         self.timestamp_font = get_images_timestamp_font(config)
+        self.debounce_seconds = debounce_seconds
+
+        # Only accessed from the observer thread, so it doesn't need a lock
+        self._recent_file_stats: OrderedDict[pathlib.Path, tuple[int, int]] = (
+            OrderedDict()
+        )
+
+        self._pending_timers: dict[pathlib.Path, threading.Timer] = {}
+        self._pending_timers_lock = threading.Lock()
+        self._slideshow_refresh_timer: threading.Timer | None = None
+
+        # The files are processed, moved and deleted by worker threads consuming this queue, so
+        # the observer thread never blocks and keeps on receiving events in the meantime
+        self._operations_queue: queue.Queue[_FileOperation | None] = queue.Queue(
+            maxsize=MAX_QUEUED_OPERATIONS
+        )
+        # Only the latest queued operation for each file is run, e.g. a file which is deleted
+        # while it's still waiting to be processed is only deleted
+        self._operation_ids = itertools.count()
+        self._latest_operation_ids: dict[pathlib.Path, int] = {}
+        self._latest_operation_ids_lock = threading.Lock()
+
+        self._worker_threads = [
+            threading.Thread(
+                target=self._run_queued_operations,
+                name=f"process_file_{index}",
+                daemon=True,
+            )
+            for index in range(get_num_workers(config))
+        ]
+
+        for worker_thread in self._worker_threads:
+            worker_thread.start()
+
+    def _run_queued_operations(self) -> None:
+        # None is put in the queue to signal the worker to stop
+        while (operation := self._operations_queue.get()) is not None:
+            with self._latest_operation_ids_lock:
+                if self._latest_operation_ids.get(operation.file_path) != (
+                    operation.operation_id
+                ):
+                    logger.debug(
+                        f"Skipping a superseded {operation.action.__name__}() "
+                        f"of {operation.file_path}"
+                    )
+                    continue
+
+                del self._latest_operation_ids[operation.file_path]
+
+            operation.action(*operation.args)
+
+    def _queue_operation(
+        self,
+        file_path: pathlib.Path,
+        action: Callable[..., None],
+        *args: pathlib.Path,
+    ) -> None:
+        with self._latest_operation_ids_lock:
+            operation_id = next(self._operation_ids)
+            self._latest_operation_ids[file_path] = operation_id
+
+        self._operations_queue.put(
+            _FileOperation(operation_id, file_path, action, args or (file_path,))
+        )
+
+    def _cancel_processing_file(self, file_path: pathlib.Path) -> None:
+        with self._pending_timers_lock:
+            pending_timer = self._pending_timers.pop(file_path, None)
+
+        if pending_timer is not None:
+            logger.debug("Cancelling processing {} after a new event", file_path)
+            pending_timer.cancel()
+
+    def _schedule_processing_file(self, file_path: pathlib.Path) -> None:
+        with self._pending_timers_lock:
+            pending_timer = self._pending_timers.pop(file_path, None)
+
+            if pending_timer is not None:
+                logger.debug("Postponing processing {} after a new event", file_path)
+                pending_timer.cancel()
+
+            timer = threading.Timer(
+                self.debounce_seconds, self._on_file_settled, args=(file_path,)
+            )
+            timer.daemon = True
+            self._pending_timers[file_path] = timer
+            timer.start()
+
+    def _on_file_settled(self, file_path: pathlib.Path) -> None:
+        with self._pending_timers_lock:
+            self._pending_timers.pop(file_path, None)
+
+        try:
+            size_before = file_path.stat().st_size
+            time.sleep(SIZE_STABILITY_INTERVAL_SECONDS)
+            size_after = file_path.stat().st_size
+        except FileNotFoundError:
+            logger.debug(f"File {file_path} no longer exists, skipping processing it")
+            return
+
+        if size_before != size_after:
+            logger.debug(
+                f"File {file_path} is still being written, postponing processing it"
+            )
+            self._schedule_processing_file(file_path)
+            return
+
+        self._queue_operation(file_path, self._try_process_file)
+
+    def _schedule_refreshing_slideshow(self) -> None:
+        with self._pending_timers_lock:
+            if self._slideshow_refresh_timer is not None:
+                self._slideshow_refresh_timer.cancel()
+
+            self._slideshow_refresh_timer = threading.Timer(
+                SLIDESHOW_REFRESH_DELAY_SECONDS, self._try_refresh_slideshow
+            )
+            self._slideshow_refresh_timer.daemon = True
+            self._slideshow_refresh_timer.start()
+
+    def _try_refresh_slideshow(self) -> None:
+        with self._pending_timers_lock:
+            self._slideshow_refresh_timer = None
+
+        if not kodi.is_kodi_running():
+            return
+
+        logger.debug("Kodi is running, refreshing slideshow")
+
+        try:
+            kodi.refresh_slideshow(self.config)
+        except Exception:
+            logger.exception("Error refreshing the slideshow")
+
+    def shutdown(self) -> None:
+        with self._pending_timers_lock:
+            for timer in self._pending_timers.values():
+                timer.cancel()
+
+            self._pending_timers.clear()
+
+            if self._slideshow_refresh_timer is not None:
+                self._slideshow_refresh_timer.cancel()
+
+        for _ in self._worker_threads:
+            self._operations_queue.put(None)
+
+        for worker_thread in self._worker_threads:
+            worker_thread.join()
 
     def _try_process_file(self, file_path: pathlib.Path) -> None:
         if file_path.name.startswith("."):
             logger.debug(f"Skipping processing hidden file {file_path}")
             return
 
-        # Adding one second sleep will ensure that the check bellow will be correct
-        # This is because sometimes the ._ file is created after the main file
-        # (or at least that's the order they were detected)
-        time.sleep(1)
-
-        if (file_path.parent / f"._{file_path.name}").exists():
+        # NOTE: Sometimes the ._ file is created after the main file (or at least that's the
+        # order they were detected), the debouncing gives it the time to appear if that's the case
+        if _has_sidecar_file(os.fspath(file_path)):
             logger.debug(f"Skipping processing temporary file {file_path}")
             return
 
+        # A modified event is also emitted when a file is only touched (or copied over
+        # with the same contents), there's no need to run the whole pipeline again then
+        if not self.config.force_regenerate and is_output_up_to_date(
+            file_path, self.config
+        ):
+            logger.debug(
+                f"Output of {file_path.name} is newer than the file itself, skipping"
+            )
+            return
+
         try:
             if file_path.suffix.lower() == ".jpg":
                 dest_path = process_single_image(
@@ -61,9 +261,7 @@ class RetrosnapFileHandler(PatternMatchingEventHandler):
         else:
             logger.debug(f"Successfully processed file {file_path} -> {dest_path}")
 
-            if kodi.is_kodi_running():
-                logger.debug("Kodi is running, refreshing slideshow")
-                kodi.refresh_slideshow(self.config)
+            self._schedule_refreshing_slideshow()
 
     def _try_delete_processed_file(self, file_path: pathlib.Path) -> None:
         if file_path.name.startswith("."):
@@ -83,55 +281,129 @@ class RetrosnapFileHandler(PatternMatchingEventHandler):
         else:
             logger.debug(f"Successfully deleted file {processed_file_path}")
 
-            if kodi.is_kodi_running():
-                logger.debug("Kodi is running, refreshing slideshow")
-                kodi.refresh_slideshow(self.config)
+            self._schedule_refreshing_slideshow()
 
     def _try_log_file_stats(self, file_path: pathlib.Path) -> None:
         try:
-            logger.debug(f"File stats: {file_path.stat()}")
+            logger.opt(lazy=True).debug("File stats: {}", file_path.stat)
         except Exception:
             logger.warning(f"Unable to log file stats for {file_path}", exc_info=True)
 
+    def _is_duplicate_event(self, file_path: pathlib.Path) -> bool:
+        try:
+            file_stat = file_path.stat()
+        except OSError:
+            logger.warning(f"Unable to log file stats for {file_path}", exc_info=True)
+            return False
+
+        logger.debug("File stats: {}", file_stat)
+
+        # The same write is often reported several times (and simply opening a file in
+        # Finder causes a modification event), there's nothing new to process unless
+        # the file's contents (as far as stat() can tell) have changed since then
+        mtime_and_size = (file_stat.st_mtime_ns, file_stat.st_size)
+        is_duplicate = self._recent_file_stats.get(file_path) == mtime_and_size
+
+        self._recent_file_stats[file_path] = mtime_and_size
+        self._recent_file_stats.move_to_end(file_path)
+
+        if len(self._recent_file_stats) > MAX_RECENT_EVENTS:
+            self._recent_file_stats.popitem(last=False)
+
+        return is_duplicate
+
+    # NOTE: The event handlers pass the arguments of their debug messages to loguru rather than
+    # using f-strings, so the messages are only formatted when DEBUG logs are actually enabled
+
     def on_created(self, event: FileCreatedEvent) -> None:  # type: ignore[override]
-        file_path = pathlib.Path(event.src_path)  # type: ignore[arg-type]
+        src_path = os.fsdecode(event.src_path)
+        logger.debug("Detected file created: {}", src_path)
 
-        logger.debug(f"Detected file created: {file_path}")
+        if _is_hidden_file(src_path):
+            logger.debug("Skipping processing hidden file {}", src_path)
+            return
 
-        self._try_log_file_stats(file_path)
-        self._try_process_file(file_path)
+        file_path = pathlib.Path(src_path)
+
+        if self._is_duplicate_event(file_path):
+            logger.debug(
+                "File {} hasn't changed since the last event, skipping", file_path
+            )
+            return
+
+        self._schedule_processing_file(file_path)
 
     def on_modified(self, event: FileModifiedEvent) -> None:  # type: ignore[override]
-        file_path = pathlib.Path(event.src_path)  # type: ignore[arg-type]
-        logger.debug(f"Detected file modified: {file_path}")
-        self._try_log_file_stats(file_path)
+        src_path = os.fsdecode(event.src_path)
+        logger.debug("Detected file modified: {}", src_path)
 
-        if file_path.name.startswith("."):
-            logger.debug(f"Skipping processing hidden file {file_path}")
+        if _is_hidden_file(src_path):
+            logger.debug("Skipping processing hidden file {}", src_path)
             return
 
-        processed_file_path = get_output_path(file_path, self.config)
-        if processed_file_path.exists():
+        file_path = pathlib.Path(src_path)
+
+        if self._is_duplicate_event(file_path):
+            logger.debug(
+                "File {} hasn't changed since the last event, skipping", file_path
+            )
+            return
+
+        # The file has just been stat()-ed when checking for duplicate events
+        recent_file_stats = self._recent_file_stats.get(file_path)
+
+        if not self.config.force_regenerate and is_output_up_to_date(
+            file_path,
+            self.config,
+            source_mtime_ns=recent_file_stats[0] if recent_file_stats else None,
+        ):
             logger.debug(
-                f"Processed file already exists: {processed_file_path}, skipping processing it again"
+                "Output of {} is newer than the file itself, skipping", file_path.name
             )
             return
 
-        self._try_process_file(file_path)
+        self._schedule_processing_file(file_path)
 
     def on_moved(self, event: FileMovedEvent) -> None:  # type: ignore[override]
-        old_file_path = pathlib.Path(event.src_path)  # type: ignore[arg-type]
-        new_file_path = pathlib.Path(event.dest_path)  # type: ignore[arg-type]
+        old_src_path = os.fsdecode(event.src_path)
+        new_src_path = os.fsdecode(event.dest_path)
+
+        logger.debug("Detected file moved: {} -> {}", old_src_path, new_src_path)
+
+        is_in_source_files_dir = new_src_path.startswith(
+            os.path.join(self.config.source_files_dir, "")  # noqa: PTH118
+        )
+        new_file_path = pathlib.Path(new_src_path)
+
+        # e.g. rsync writes to a hidden temporary file and then renames it, which is the
+        # first time the file is seen by the handler under its actual name
+        if _is_hidden_file(old_src_path):
+            if is_in_source_files_dir and not _is_hidden_file(new_src_path):
+                self._schedule_processing_file(new_file_path)
+
+            return
 
-        logger.debug(f"Detected file moved: {old_file_path} -> {new_file_path}")
+        old_file_path = pathlib.Path(old_src_path)
         self._try_log_file_stats(new_file_path)
 
-        # check if moved outside of self.config.source_files_dir
-        if not new_file_path.is_relative_to(self.config.source_files_dir):
-            logger.debug(f"File moved outside of source directory: {new_file_path}")
-            self._try_delete_processed_file(old_file_path)
+        self._cancel_processing_file(old_file_path)
+        self._recent_file_stats.pop(old_file_path, None)
+
+        if not is_in_source_files_dir:
+            logger.debug("File moved outside of source directory: {}", new_file_path)
+            self._queue_operation(old_file_path, self._try_delete_processed_file)
             return
 
+        self._queue_operation(
+            old_file_path,
+            self._try_move_processed_file,
+            old_file_path,
+            new_file_path,
+        )
+
+    def _try_move_processed_file(
+        self, old_file_path: pathlib.Path, new_file_path: pathlib.Path
+    ) -> None:
         old_processed_file_path = get_output_path(old_file_path, self.config)
         new_processed_file_path = get_output_path(new_file_path, self.config)
 
@@ -139,7 +411,12 @@ class RetrosnapFileHandler(PatternMatchingEventHandler):
             logger.debug(
                 f"Moving processed file {old_processed_file_path} -> {new_processed_file_path}"
             )
-            shutil.move(old_processed_file_path, new_processed_file_path)
+            _move_file(old_processed_file_path, new_processed_file_path)
+        except FileNotFoundError:
+            logger.debug(
+                f"Processed file {old_processed_file_path} not found, processing {new_file_path} instead"
+            )
+            self._try_process_file(new_file_path)
         except Exception:
             logger.exception(
                 f"Error moving file {old_processed_file_path} -> {new_processed_file_path}"
@@ -149,38 +426,172 @@ class RetrosnapFileHandler(PatternMatchingEventHandler):
                 f"Successfully moved file {old_processed_file_path} -> {new_processed_file_path}"
             )
 
-            if kodi.is_kodi_running():
-                logger.debug("Kodi is running, refreshing slideshow")
-                kodi.refresh_slideshow(self.config)
+            self._schedule_refreshing_slideshow()
 
     def on_deleted(self, event: FileDeletedEvent) -> None:  # type: ignore[override]
-        old_file_path = pathlib.Path(event.src_path)  # type: ignore[arg-type]
-        logger.debug(f"Detected file deleted: {old_file_path}")
-        self._try_delete_processed_file(old_file_path)
+        src_path = os.fsdecode(event.src_path)
+        logger.debug("Detected file deleted: {}", src_path)
+
+        if _is_hidden_file(src_path):
+            logger.debug("Skipping deleting hidden file {}", src_path)
+            return
+
+        old_file_path = pathlib.Path(src_path)
+
+        self._cancel_processing_file(old_file_path)
+        self._recent_file_stats.pop(old_file_path, None)
+        self._queue_operation(old_file_path, self._try_delete_processed_file)
+
+
+def _move_file(src_path: pathlib.Path, dest_path: pathlib.Path) -> None:
+    # Both files are in the output directory, so they're almost always on the same file system
+    # where a rename is all it takes, shutil.move() is only needed to copy the file otherwise
+    try:
+        src_path.replace(dest_path)
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+
+        shutil.move(src_path, dest_path)
+
+
+def _is_hidden_file(src_path: str) -> bool:
+    # Checked for every event before building a Path for it, which is only done for the
+    # files which are actually processed (many of the events are for the ._ sidecar files)
+    return src_path.rpartition(os.sep)[2].startswith(".")
+
+
+def _has_sidecar_file(src_path: str) -> bool:
+    # macOS creates a ._<name> file next to every file copied to a non-HFS drive
+    file_dir, _, file_name = src_path.rpartition(os.sep)
+
+    return os.path.exists(f"{file_dir}{os.sep}._{file_name}")  # noqa: PTH110
+
+
+class ConfigFileHandler(FileSystemEventHandler):
+    def __init__(
+        self, config_file: pathlib.Path, file_handler: RetrosnapFileHandler
+    ) -> None:
+        super().__init__()
+        self.config_file = config_file
+        # All the events in the config file's directory are compared against it
+        self._config_file_str = os.fspath(config_file)
+        self.file_handler = file_handler
+
+    def on_modified(self, event: FileSystemEvent) -> None:
+        if os.fsdecode(event.src_path) == self._config_file_str:
+            self._reload_config()
+
+    def on_moved(self, event: FileSystemEvent) -> None:
+        # Most editors save a file by writing a new one and moving it over the old one,
+        # which (unlike polling) the native observers report as a move
+        if os.fsdecode(event.dest_path) == self._config_file_str:
+            self._reload_config()
+
+    def _reload_config(self) -> None:
+        logger.info(
+            f"Detected config file modified, reloading it from {self.config_file}"
+        )
+
+        try:
+            config = Config.load_from_file(self.config_file)
+            timestamp_font = get_images_timestamp_font(config)
+        except Exception:
+            logger.exception("Error reloading the config file, keeping the old config")
+            return
+
+        self.file_handler.config = config
+        self.file_handler.timestamp_font = timestamp_font
+
+
+def _is_on_network_file_system(path: pathlib.Path) -> bool:
+    # Native file system events are not delivered for the changes made to a network file
+    # system by other machines, /proc/mounts is only available on Linux though
+    try:
+        mounts = pathlib.Path("/proc/mounts").read_text()
+    except OSError:
+        return False
+
+    path_str = os.fspath(path)
+    file_system_type = ""
+    longest_mount_point = ""
+
+    for mount in mounts.splitlines():
+        _, mount_point, mount_file_system_type, *_ = mount.split()
+        # Spaces (and a few other characters) in the mount points are octal-escaped
+        mount_point = mount_point.replace("\\040", " ")
+
+        if (
+            path_str == mount_point
+            or path_str.startswith(os.path.join(mount_point, ""))  # noqa: PTH118
+        ) and len(mount_point) > len(longest_mount_point):
+            longest_mount_point = mount_point
+            file_system_type = mount_file_system_type
+
+    return file_system_type in NETWORK_FILE_SYSTEM_TYPES
 
 
 def observe_and_action_fs_events(
     config: Config,
     *,
+    config_file: pathlib.Path | None = None,
     recursive: bool = True,
-    sleep_time: float = 0.1,
+    sleep_time: float = 1,
+    debounce_time: float = DEBOUNCE_SECONDS,
+    polling: bool = False,
 ) -> None:
     logger.info(
         f"Starting to observe file system events for source files in {config.source_files_dir}"
     )
 
-    file_handler = RetrosnapFileHandler(config)
-    observer = PollingObserver()
+    file_handler = RetrosnapFileHandler(config, debounce_seconds=debounce_time)
+
+    def schedule_handlers(observer: BaseObserver) -> None:
+        observer.schedule(
+            file_handler, str(config.source_files_dir), recursive=recursive
+        )
+
+        # The config file is watched by the same observer (and thread) as the source files
+        if config_file is not None:
+            observer.schedule(
+                ConfigFileHandler(config_file, file_handler),
+                str(config_file.parent),
+                recursive=False,
+            )
+
+    if not polling and _is_on_network_file_system(config.source_files_dir):
+        logger.info(
+            f"{config.source_files_dir} is on a network file system, polling it for changes"
+        )
+        polling = True
 
-    observer.schedule(
-        file_handler, str(config.source_files_dir.resolve()), recursive=recursive
+    # The native observer (inotify on Linux) is told about the changes by the kernel rather
+    # than stat()-ing every file in the source directory on every check like polling does
+    observer: BaseObserver = (
+        PollingObserver(timeout=sleep_time) if polling else Observer(timeout=sleep_time)
     )
-    observer.start()
+    schedule_handlers(observer)
 
     try:
-        while True:
-            time.sleep(sleep_time)
+        observer.start()
+    except OSError:
+        if polling:
+            raise
+
+        # e.g. when the inotify watches limit (fs.inotify.max_user_watches) is reached
+        logger.opt(exception=True).warning(
+            "Unable to start the native file system observer, polling for changes instead"
+        )
+        observer = PollingObserver(timeout=sleep_time)
+        schedule_handlers(observer)
+        observer.start()
+
+    try:
+        # Block until the observer thread stops (or the process is interrupted)
+        # rather than waking up the main thread periodically to check on it
+        observer.join()
     finally:
         logger.info("Stopping file system observer")
         observer.stop()
         observer.join()
+        file_handler.shutdown()
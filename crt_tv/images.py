@@ -1,76 +1,466 @@
+import dataclasses
 import datetime
+import functools
+import io
+import math
 import pathlib
-from typing import Literal
+import subprocess
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from loguru import logger
 from PIL.Image import Image
+from PIL.Image import fromarray as image_fromarray
+from PIL.Image import new as new_image
 from PIL.Image import open as image_open
+from PIL.ImageColor import getcolor
 from PIL.ImageDraw import Draw
 from PIL.ImageFont import FreeTypeFont
 
 from crt_tv.config import Config
-from crt_tv.resize import get_new_dimensions
-from crt_tv.timestamp import parse_timestamp_from_image
-from crt_tv.utils import get_output_path
+from crt_tv.ocr import images_to_text
+from crt_tv.profiling import measure_stage
+from crt_tv.resize import get_new_dimensions_for_aspect_ratio
+from crt_tv.timestamp import (
+    crop_timestamp_region,
+    parse_timestamp_from_region,
+    parse_timestamp_from_text,
+    read_exif_timestamp,
+)
+from crt_tv.utils import get_output_path, prefetch_files
+
+PIPELINE_MAX_IN_FLIGHT_BATCHES = 2
 
 
 def process_single_image(image_path: pathlib.Path, config: Config, timestamp_font: FreeTypeFont) -> pathlib.Path:
     logger.info(f"Processing {image_path.name}")
 
+    timestamp_region, img = _read_image(image_path, config)
+    exif_timestamp = _read_image_exif_timestamp(img, config)
+
+    if exif_timestamp is not None:
+        with measure_stage("resize"):
+            resized_img = make_image_resizer(config)(img)
+
+        return _stamp_and_save_image(resized_img, image_path, exif_timestamp, config, timestamp_font)
+
+    # The timestamp only needs the (already cut) timestamp region, so it's extracted while the image is being
+    # resized (Pillow and the Tesseract subprocess release the GIL while they're working)
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="ocr") as ocr_executor:
+        image_timestamp_future = ocr_executor.submit(_extract_image_timestamp, timestamp_region, image_path, config)
+
+        with measure_stage("resize"):
+            resized_img = make_image_resizer(config)(img)
+
+        image_timestamp = image_timestamp_future.result()
+
+    return _stamp_and_save_image(resized_img, image_path, image_timestamp, config, timestamp_font)
+
+
+def _read_image_exif_timestamp(img: Image, config: Config) -> datetime.datetime | None:
+    if not config.images.timestamp.use_exif:
+        return None
+
+    return read_exif_timestamp(img)
+
+
+def _extract_image_timestamp(
+    timestamp_region: Image,
+    image_path: pathlib.Path,
+    config: Config,
+) -> datetime.datetime | datetime.date | None:
+    try:
+        return parse_timestamp_from_region(
+            timestamp_region,
+            config,
+            failed_timestamp_filename=image_path.name,
+        )
+    except ValueError:
+        logger.warning(f"No timestamp found in {image_path.name}")
+    except RuntimeError:
+        logger.opt(exception=True).warning(f"Tesseract timed out while processing {image_path.name}")
+
+    return None
+
+
+def process_image_batches(
+    image_path_batches: list[list[pathlib.Path]],
+    config: Config,
+    timestamp_font: FreeTypeFont,
+) -> list[pathlib.Path]:
+    # The batches are processed as a pipeline, each stage runs in its own thread so decoding & resizing the next
+    # batch, waiting for Tesseract to extract the timestamps of the current one and stamping & saving the previous
+    # one all overlap (Pillow and the Tesseract subprocess release the GIL while they're working)
+    resize_img = make_image_resizer(config)
+    output_image_paths: list[pathlib.Path] = []
+    in_flight_batches: deque[Future[_DecodedImageBatch]] = deque()
+
+    with (
+        ThreadPoolExecutor(max_workers=1, thread_name_prefix="decode") as decode_executor,
+        ThreadPoolExecutor(max_workers=1, thread_name_prefix="ocr") as ocr_executor,
+    ):
+        for image_paths in image_path_batches:
+            # The files are prefetched when the batch is queued rather than when its decoding starts, so they're
+            # read from the disk while the batches ahead of it are still being decoded
+            prefetch_files(image_paths)
+
+            decoded_batch_future = decode_executor.submit(_decode_image_batch, image_paths, resize_img, config)
+            in_flight_batches.append(ocr_executor.submit(_extract_image_batch_timestamps, decoded_batch_future, config))
+
+            # Bound the number of decoded batches kept in memory while waiting to be saved
+            if len(in_flight_batches) > PIPELINE_MAX_IN_FLIGHT_BATCHES:
+                output_image_paths += _stamp_and_save_image_batch(
+                    in_flight_batches.popleft().result(), config, timestamp_font
+                )
+
+        while in_flight_batches:
+            output_image_paths += _stamp_and_save_image_batch(
+                in_flight_batches.popleft().result(), config, timestamp_font
+            )
+
+    return output_image_paths
+
+
+@dataclasses.dataclass
+class _DecodedImageBatch:
+    image_paths: list[pathlib.Path]
+    timestamp_regions: list[Image]
+    resized_imgs: list[Image]
+    image_timestamps: list[datetime.datetime | datetime.date | None]
+
+
+def _decode_image(
+    image_path: pathlib.Path,
+    resize_img: Callable[[Image], Image],
+    config: Config,
+) -> tuple[Image, Image, datetime.datetime | None]:
+    timestamp_region, img = _read_image(image_path, config)
+    # The resized image doesn't keep the EXIF data of the original one
+    exif_timestamp = _read_image_exif_timestamp(img, config)
+
+    with measure_stage("resize"):
+        resized_img = resize_img(img)
+
+    return timestamp_region, resized_img, exif_timestamp
+
+
+def _read_image(image_path: pathlib.Path, config: Config) -> tuple[Image, Image]:
+    max_size = config.images.max_size
+
+    if max_size is None:
+        with image_open(image_path) as img:
+            with measure_stage("decode"):
+                img.load()
+
+        # Each image is decoded only once, both the timestamp region and the resized image are
+        # cut from the same decoded image
+        return crop_timestamp_region(img, config.images.timestamp.detect_region), img
+
+    # When the image is downscaled, the JPEG decoder can decode it directly at 1/2, 1/4 or 1/8 of its size which
+    # is a lot faster than a full decode. The image is still decoded only once, draft() never scales it below
+    # max_size so the timestamp is read from the same (scaled down) decode, with its region scaled the same way
     with image_open(image_path) as img:
+        orig_width, orig_height = img.size
+        img.draft("RGB", max_size)
+
+        with measure_stage("decode"):
+            img.load()
+
+    region_width, region_height = config.images.timestamp.detect_region
+    scaled_region_size = (
+        math.ceil(region_width * img.width / orig_width),
+        math.ceil(region_height * img.height / orig_height),
+    )
+
+    return crop_timestamp_region(img, scaled_region_size), img
+
+
+def _decode_image_batch(
+    image_paths: list[pathlib.Path],
+    resize_img: Callable[[Image], Image],
+    config: Config,
+) -> _DecodedImageBatch:
+    logger.info(f"Processing a batch of {len(image_paths)} images")
+
+    decoded_batch = _DecodedImageBatch(image_paths=[], timestamp_regions=[], resized_imgs=[], image_timestamps=[])
+
+    for image_path in image_paths:
+        try:
+            timestamp_region, resized_img, exif_timestamp = _decode_image(image_path, resize_img, config)
+        except OSError:
+            logger.exception(f"Unable to read image {image_path}, skipping it")
+            continue
+
+        decoded_batch.image_paths.append(image_path)
+        decoded_batch.timestamp_regions.append(timestamp_region)
+        decoded_batch.resized_imgs.append(resized_img)
+        decoded_batch.image_timestamps.append(exif_timestamp)
+
+    return decoded_batch
+
+
+def _extract_image_batch_timestamps(
+    decoded_batch_future: Future[_DecodedImageBatch],
+    config: Config,
+) -> _DecodedImageBatch:
+    decoded_batch = decoded_batch_future.result()
+    # The images which already have a timestamp (from their EXIF data) don't need to be OCR'd
+    ocr_indices = [index for index, timestamp in enumerate(decoded_batch.image_timestamps) if timestamp is None]
+
+    if not ocr_indices:
+        return decoded_batch
+
+    logger.info(f"Extracting the timestamps of {len(ocr_indices)} images")
+
+    try:
+        extracted_texts = images_to_text(
+            [decoded_batch.timestamp_regions[index] for index in ocr_indices], config, config.images.timestamp
+        )
+    except RuntimeError:
+        logger.opt(exception=True).warning(f"Tesseract failed while processing a batch of {len(ocr_indices)} images")
+        return decoded_batch
+
+    for index, extracted_text in zip(ocr_indices, extracted_texts, strict=True):
+        image_path = decoded_batch.image_paths[index]
+
         try:
-            image_timestamp = parse_timestamp_from_image(img, config, failed_timestamp_filename=image_path.name)
+            decoded_batch.image_timestamps[index] = parse_timestamp_from_text(
+                extracted_text,
+                config,
+                timestamp_region=decoded_batch.timestamp_regions[index],
+                failed_timestamp_filename=image_path.name,
+            )
         except ValueError:
             logger.warning(f"No timestamp found in {image_path.name}")
-            image_timestamp = None
-        except RuntimeError:
-            logger.opt(exception=True).warning(f"Tesseract timed out while processing {image_path.name}")
-            image_timestamp = None
-
-        resized_img = resize_image(
-            img,
-            new_aspect_ratio=config.aspect_ratio,
-            resize_method=config.resize_method,
-        )
 
-        if image_timestamp is not None:
-            draw_timestamp(
-                resized_img,
-                image_timestamp,
-                font=timestamp_font,
-                config=config,
+    return decoded_batch
+
+
+def _stamp_and_save_image_batch(
+    decoded_batch: _DecodedImageBatch,
+    config: Config,
+    timestamp_font: FreeTypeFont,
+) -> list[pathlib.Path]:
+    output_image_paths: list[pathlib.Path] = []
+
+    for image_path, resized_img, image_timestamp in zip(
+        decoded_batch.image_paths, decoded_batch.resized_imgs, decoded_batch.image_timestamps, strict=True
+    ):
+        # A single image which can't be stamped or saved shouldn't take the rest of the task down with it
+        try:
+            output_image_paths.append(
+                _stamp_and_save_image(resized_img, image_path, image_timestamp, config, timestamp_font)
             )
+        except Exception:
+            logger.exception(f"Unable to save image {image_path}, skipping it")
 
-        output_image_path = get_output_path(image_path, config).resolve()
-        resized_img.save(output_image_path)
+    return output_image_paths
+
+
+def _stamp_and_save_image(
+    resized_img: Image,
+    image_path: pathlib.Path,
+    image_timestamp: datetime.datetime | datetime.date | None,
+    config: Config,
+    timestamp_font: FreeTypeFont,
+) -> pathlib.Path:
+    if image_timestamp is not None:
+        draw_timestamp(
+            resized_img,
+            image_timestamp,
+            font=timestamp_font,
+            config=config,
+        )
+
+    output_image_path = get_output_path(image_path, config)
+    # Encode a baseline JPEG with 4:2:0 chroma subsampling and the default Huffman tables,
+    # optimize=True or progressive=True would need an extra pass over the image data
+    with measure_stage("encode"):
+        if config.images.jpeg_encoder == "cjpeg":
+            _save_image_with_cjpeg(resized_img, output_image_path, config)
+        else:
+            # The JPEG is encoded in memory and written with a single call, rather than the encoder writing it to
+            # the file a block at a time, so a failed encode doesn't leave behind a truncated output which would
+            # look up to date on the next run
+            jpeg_buffer = io.BytesIO()
+            resized_img.save(
+                jpeg_buffer,
+                format="JPEG",
+                quality=config.images.jpeg_quality,
+                subsampling="4:2:0",
+                optimize=False,
+                progressive=False,
+            )
+            output_image_path.write_bytes(jpeg_buffer.getbuffer())
 
     logger.info(f"Completed processing image {image_path.name}")
 
     return output_image_path
 
 
-def resize_image(img: Image, new_aspect_ratio: str, *, resize_method: Literal["stretch", "crop"]) -> Image:
-    orig_width, orig_height = img.size
+def _save_image_with_cjpeg(img: Image, output_image_path: pathlib.Path, config: Config) -> None:
+    # The raw pixels are piped to cjpeg as a PPM (or PGM for grayscale images) which it reads without decoding
+    ppm_buffer = io.BytesIO()
+    img.save(ppm_buffer, format="PPM")
 
-    new_width, new_height = get_new_dimensions(
-        orig_width,
-        orig_height,
-        new_aspect_ratio,
-        resize_method=resize_method,
-    )
+    try:
+        subprocess.run(
+            [
+                "cjpeg",
+                "-quality",
+                str(config.images.jpeg_quality),
+                "-sample",
+                "2x2",
+                "-outfile",
+                str(output_image_path),
+            ],
+            input=ppm_buffer.getbuffer(),
+            capture_output=True,
+            check=True,
+        )
+    except subprocess.CalledProcessError as exc:
+        raise RuntimeError(f"cjpeg failed to save {output_image_path}: {exc.stderr.decode().strip()}") from exc
+
+
+def make_image_resizer(config: Config) -> Callable[[Image], Image]:
+    # The aspect ratio and the resize method are the same for all images, so they're only parsed once and
+    # since all images from the camera have the same size, the new dimensions are only calculated once too
+    aspect_ratio_width, aspect_ratio_height = config.aspect_ratio_wh
+    aspect_ratio = aspect_ratio_width / aspect_ratio_height
+    resize_method = config.resize_method
+    max_size = config.images.max_size
+    resample_image = _make_image_resampler(config)
+
+    @functools.cache
+    def get_resized_size(orig_width: int, orig_height: int) -> tuple[int, int]:
+        return get_new_dimensions_for_aspect_ratio(orig_width, orig_height, aspect_ratio, resize_method=resize_method)
+
+    @functools.cache
+    def get_crop_box(orig_width: int, orig_height: int) -> tuple[int, int, int, int]:
+        new_width, new_height = get_resized_size(orig_width, orig_height)
 
-    if resize_method == "stretch":
-        resized_img = img.resize((new_width, new_height))
-    elif resize_method == "crop":
         left = (orig_width - new_width) // 2
         top = (orig_height - new_height) // 2
         right = (orig_width + new_width) // 2
         bottom = (orig_height + new_height) // 2
 
-        resized_img = img.crop((left, top, right, bottom))
+        return left, top, right, bottom
+
+    @functools.cache
+    def fit_into_max_size(width: int, height: int) -> tuple[int, int]:
+        if max_size is None:
+            return width, height
+
+        max_width, max_height = max_size
+        scale = min(max_width / width, max_height / height, 1)
+
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+    # NOTE: When the image already has the right aspect ratio (and size) it's returned as is rather than
+    # copied, the timestamp is then drawn directly onto the decoded image which isn't used for anything else
+
+    def stretch_image(img: Image) -> Image:
+        fitted_size = fit_into_max_size(*get_resized_size(*img.size))
+
+        if fitted_size == img.size:
+            return img
+
+        return resample_image(img, fitted_size, None)
+
+    def crop_image(img: Image) -> Image:
+        crop_box = get_crop_box(*img.size)
+        left, top, right, bottom = crop_box
+        cropped_size = (right - left, bottom - top)
+        fitted_size = fit_into_max_size(*cropped_size)
+
+        if fitted_size == cropped_size:
+            return img if cropped_size == img.size else img.crop(crop_box)
+
+        # Only the cropped part of the image is resampled, rather than copying it into a new image first
+        return resample_image(img, fitted_size, crop_box)
+
+    if resize_method == "stretch":
+        return stretch_image
+    elif resize_method == "crop":
+        return crop_image
     else:
         raise ValueError(f"Invalid resize method '{resize_method}', must be 'stretch' or 'crop'")
-    return resized_img
+
+
+def _make_image_resampler(
+    config: Config,
+) -> Callable[[Image, tuple[int, int], tuple[int, int, int, int] | None], Image]:
+    # The returned function resamples the box (the whole image if it's None) of the image to the given size
+    resample = config.images.resample_filter
+    reducing_gap = config.images.reducing_gap
+
+    if config.images.resize_backend == "pillow":
+        return lambda img, size, box: img.resize(size, resample=resample, box=box, reducing_gap=reducing_gap)
+
+    if config.images.resize_backend == "cykooz":
+        return _make_image_resampler_with_cykooz(config)
+
+    # Imported lazily since opencv is an optional dependency
+    import cv2
+    import numpy as np
+
+    interpolation = {
+        "nearest": cv2.INTER_NEAREST,
+        "box": cv2.INTER_AREA,
+        "bilinear": cv2.INTER_LINEAR,
+        "hamming": cv2.INTER_AREA,  # OpenCV has no Hamming filter, area interpolation is the closest to it
+        "bicubic": cv2.INTER_CUBIC,
+        "lanczos": cv2.INTER_LANCZOS4,
+    }[config.images.resample]
+
+    def resample_image_with_opencv(img: Image, size: tuple[int, int], box: tuple[int, int, int, int] | None) -> Image:
+        # cv2.resize() doesn't care about the channels order, so the RGB data of the image is used as is
+        img_data = np.asarray(img)
+
+        if box is not None:
+            # Slicing the array is only a view of the box, cv2.resize() reads it without copying it first
+            left, top, right, bottom = box
+            img_data = img_data[top:bottom, left:right]
+
+        return image_fromarray(cv2.resize(img_data, size, interpolation=interpolation))
+
+    return resample_image_with_opencv
+
+
+def _make_image_resampler_with_cykooz(
+    config: Config,
+) -> Callable[[Image, tuple[int, int], tuple[int, int, int, int] | None], Image]:
+    # Imported lazily since cykooz.resizer is an optional dependency
+    from cykooz_resizer import CropBox, FilterType, ResizeAlg, ResizeOptions, Resizer
+
+    resize_alg = {
+        "nearest": ResizeAlg.nearest(),
+        "box": ResizeAlg.convolution(FilterType.box),
+        "bilinear": ResizeAlg.convolution(FilterType.bilinear),
+        "hamming": ResizeAlg.convolution(FilterType.bilinear),  # There's no Hamming filter, bilinear is the closest
+        "bicubic": ResizeAlg.convolution(FilterType.catmull_rom),  # Pillow's bicubic filter is Catmull-Rom
+        "lanczos": ResizeAlg.convolution(FilterType.lanczos3),
+    }[config.images.resample]
+
+    # The resizer keeps the buffers it reuses between the images, the images of a task are all resized in its
+    # decode thread so there are no concurrent calls to it
+    resizer = Resizer()
+
+    def resample_image_with_cykooz(img: Image, size: tuple[int, int], box: tuple[int, int, int, int] | None) -> Image:
+        options = ResizeOptions(resize_alg=resize_alg)
+
+        if box is not None:
+            # The box is only read from the source image rather than it being cropped (copied) first
+            left, top, right, bottom = box
+            options.crop_box = CropBox(left, top, right - left, bottom - top)
+
+        resized_img = new_image(img.mode, size)
+        resizer.resize_pil(img, resized_img, options)
+
+        return resized_img
+
+    return resample_image_with_cykooz
 
 
 def draw_timestamp(
@@ -90,36 +480,31 @@ def draw_timestamp(
     else:
         raise TypeError(f"timestamp must be a datetime.datetime or datetime.date instance, got {type(timestamp)}")
 
-    draw = Draw(img)
-    text_bbox_left, text_bbox_top, text_bbox_right, text_bbox_bottom = draw.textbbox(
-        xy=(0, 0),
-        text=timestamp_text,
+    timestamp_config = config.images.timestamp
+    timestamp_tile = _render_timestamp_tile(
+        timestamp_text,
         font=font,
+        mode=img.mode,
+        fg_color=(
+            timestamp_config.fg_color_rgb if img.mode == "RGB" else getcolor(timestamp_config.fg_color, img.mode)
+        ),
+        bg_color=(
+            timestamp_config.bg_color_rgb if img.mode == "RGB" else getcolor(timestamp_config.bg_color, img.mode)
+        ),
+        padding=(
+            timestamp_config.padding_left,
+            timestamp_config.padding_top,
+            timestamp_config.padding_right,
+            timestamp_config.padding_bottom,
+        ),
     )
 
-    text_width = text_bbox_right - text_bbox_left
-    text_height = text_bbox_bottom - text_bbox_top
-
     left_x = 0
-    right_x = int(
-        img.width
-        - text_width
-        - config.images.timestamp.margin_left
-        - config.images.timestamp.margin_right
-        - config.images.timestamp.padding_left
-        - config.images.timestamp.padding_right
-    )
+    right_x = img.width - timestamp_tile.width - timestamp_config.margin_left - timestamp_config.margin_right + 1
     top_y = 0
-    bottom_y = int(
-        img.height
-        - text_height
-        - config.images.timestamp.margin_top
-        - config.images.timestamp.margin_bottom
-        - config.images.timestamp.padding_top
-        - config.images.timestamp.padding_bottom
-    )
+    bottom_y = img.height - timestamp_tile.height - timestamp_config.margin_top - timestamp_config.margin_bottom + 1
 
-    match config.images.timestamp.position:
+    match timestamp_config.position:
         case "top left":
             timestamp_x, timestamp_y = (left_x, top_y)
         case "top right":
@@ -131,25 +516,44 @@ def draw_timestamp(
         case _:
             raise RuntimeError("invalid branch")
 
-    bg_rect_left = timestamp_x + config.images.timestamp.margin_left
-    bg_rect_top = timestamp_y + config.images.timestamp.margin_top
-    bg_rect_right = (
-        bg_rect_left + config.images.timestamp.padding_left + text_width + config.images.timestamp.padding_right
-    )
-    bg_rect_bottom = (
-        bg_rect_top + config.images.timestamp.padding_top + text_height + config.images.timestamp.padding_bottom
-    )
+    img.paste(timestamp_tile, (timestamp_x + timestamp_config.margin_left, timestamp_y + timestamp_config.margin_top))
 
-    text_x = bg_rect_left + config.images.timestamp.padding_left
-    text_y = bg_rect_top - text_bbox_top + config.images.timestamp.padding_top
 
-    draw.rectangle(
-        (bg_rect_left, bg_rect_top, bg_rect_right, bg_rect_bottom),
-        fill=config.images.timestamp.bg_color,
+@functools.lru_cache(maxsize=256)
+def _render_timestamp_tile(
+    timestamp_text: str,
+    *,
+    font: FreeTypeFont,
+    mode: str,
+    fg_color: float | tuple[int, ...],
+    bg_color: float | tuple[int, ...],
+    padding: tuple[int, int, int, int],
+) -> Image:
+    # The timestamp (the text on its background) is rendered on its own small image which is then pasted onto the
+    # images, the same tile is reused for all images with the same timestamp, e.g. the ones with only a date or
+    # a burst of photos taken in the same second
+    padding_left, padding_top, padding_right, padding_bottom = padding
+
+    text_bbox_left, text_bbox_top, text_bbox_right, text_bbox_bottom = font.getbbox(timestamp_text)
+    text_width = text_bbox_right - text_bbox_left
+    text_height = text_bbox_bottom - text_bbox_top
+
+    # The background used to be drawn with draw.rectangle() whose box includes its right and bottom edges, hence
+    # the +1s to keep the same size
+    timestamp_tile = new_image(
+        mode,
+        (
+            int(padding_left + text_width + padding_right) + 1,
+            int(padding_top + text_height + padding_bottom) + 1,
+        ),
+        bg_color,
     )
-    draw.text(
-        xy=(text_x, text_y),
+
+    Draw(timestamp_tile).text(
+        xy=(padding_left, padding_top - text_bbox_top),
         text=timestamp_text,
-        fill=config.images.timestamp.fg_color,
+        fill=fg_color,
         font=font,
     )
+
+    return timestamp_tile
@@ -1,16 +1,68 @@
+import base64
 import functools
+import http.client
+import json
+import os
 import subprocess
+import threading
+import time
+import urllib.parse
+from typing import Any
 
 from crt_tv.config import Config
 
+# is_kodi_running() is called several times for every refresh of the slideshow, so the result
+# of looking for the Kodi process is reused for this long instead of every time
+KODI_RUNNING_CACHE_SECONDS = 1.0
+
+# (time.monotonic() when the Kodi process was looked for, whether Kodi was running)
+_kodi_running_state: tuple[float, bool] | None = None
+
+
+# The JSON-RPC connections are kept alive and reused for all the requests to the same URL, the
+# lock makes sure only a single request is sent on each of them at a time
+_jsonrpc_connections: dict[str, tuple[http.client.HTTPConnection, str, dict[str, str]]] = {}
+_jsonrpc_connections_lock = threading.Lock()
+
 
 def is_kodi_running() -> bool:
+    global _kodi_running_state
+
+    now = time.monotonic()
+
+    if _kodi_running_state is not None and now - _kodi_running_state[0] < KODI_RUNNING_CACHE_SECONDS:
+        return _kodi_running_state[1]
+
+    is_running = _find_kodi_process()
+    _kodi_running_state = (now, is_running)
+
+    return is_running
+
+
+def _find_kodi_process() -> bool:
+    # Same as `pgrep -f kodi` but reads the command lines of the processes from /proc directly
+    # instead of starting pgrep, pgrep is only used where /proc isn't available
     try:
-        output = subprocess.check_output(["pgrep", "-f", "kodi"], text=True)
-        if output:
-            return True
-    except subprocess.CalledProcessError:
-        pass
+        proc_entries = list(os.scandir("/proc"))
+    except FileNotFoundError:
+        try:
+            return bool(subprocess.check_output(["pgrep", "-f", "kodi"], text=True))
+        except subprocess.CalledProcessError:
+            return False
+
+    own_pid = str(os.getpid())
+
+    for proc_entry in proc_entries:
+        if not proc_entry.name.isdigit() or proc_entry.name == own_pid:
+            continue
+
+        try:
+            with open(os.path.join(proc_entry.path, "cmdline"), "rb") as cmdline_file:  # noqa: PTH118, PTH123
+                if b"kodi" in cmdline_file.read():
+                    return True
+        except OSError:
+            # The process has exited in the meantime (or belongs to another user on a hardened /proc)
+            continue
 
     return False
 
@@ -28,26 +80,95 @@ def require_kodi_running(func):
 
 @require_kodi_running
 def kodi_send(action: str) -> subprocess.CompletedProcess:
-    if not is_kodi_running():
-        raise RuntimeError("Kodi is not running")
-
     try:
         return subprocess.run(["kodi-send", "--action", action], check=True)
     except subprocess.CalledProcessError as e:
         raise RuntimeError(f"Failed to send action to Kodi: {e}") from e
 
 
+@require_kodi_running
+def kodi_jsonrpc(method: str, params: dict[str, Any], *, url: str) -> Any:
+    request_body = json.dumps({"jsonrpc": "2.0", "method": method, "params": params, "id": 1})
+
+    with _jsonrpc_connections_lock:
+        connection, path, headers = _get_jsonrpc_connection(url)
+
+        try:
+            response_body = _send_jsonrpc_request(connection, path, headers, request_body)
+        except (http.client.HTTPException, ConnectionError):
+            # The kept-alive connection may have been closed by Kodi in the meantime, retry once on a fresh one
+            connection.close()
+            response_body = _send_jsonrpc_request(connection, path, headers, request_body)
+
+    response = json.loads(response_body)
+
+    if "error" in response:
+        raise RuntimeError(f"Failed to call {method} on Kodi: {response['error']}")
+
+    return response.get("result")
+
+
+def _get_jsonrpc_connection(url: str) -> tuple[http.client.HTTPConnection, str, dict[str, str]]:
+    if url not in _jsonrpc_connections:
+        parsed_url = urllib.parse.urlsplit(url)
+        headers = {"Content-Type": "application/json"}
+
+        if parsed_url.username is not None:
+            credentials = f"{parsed_url.username}:{parsed_url.password or ''}".encode()
+            headers["Authorization"] = f"Basic {base64.b64encode(credentials).decode()}"
+
+        _jsonrpc_connections[url] = (
+            http.client.HTTPConnection(parsed_url.hostname or "localhost", parsed_url.port or 80, timeout=10),
+            parsed_url.path or "/jsonrpc",
+            headers,
+        )
+
+    return _jsonrpc_connections[url]
+
+
+def _send_jsonrpc_request(
+    connection: http.client.HTTPConnection,
+    path: str,
+    headers: dict[str, str],
+    request_body: str,
+) -> bytes:
+    connection.request("POST", path, body=request_body, headers=headers)
+    response = connection.getresponse()
+    response_body = response.read()
+
+    if response.status != 200:
+        raise RuntimeError(f"Kodi responded with HTTP {response.status}: {response_body!r}")
+
+    return response_body
+
+
 @require_kodi_running
 def start_slideshow(config: Config) -> None:
-    kodi_send(f"RecursiveSlideShow({config.output_files_dir.resolve()})")
+    if config.kodi.jsonrpc_url is None:
+        kodi_send(f"RecursiveSlideShow({config.output_files_dir})")
+        return
+
+    kodi_jsonrpc(
+        "Player.Open",
+        {"item": {"directory": str(config.output_files_dir), "recursive": True}},
+        url=config.kodi.jsonrpc_url,
+    )
 
 
 @require_kodi_running
 def refresh_slideshow(config: Config) -> None:
-    kodi_send("Back")
+    if config.kodi.jsonrpc_url is None:
+        kodi_send("Back")
+    else:
+        kodi_jsonrpc("Input.Back", {}, url=config.kodi.jsonrpc_url)
+
     start_slideshow(config)
 
 
 @require_kodi_running
-def open_shutdown_menu() -> None:
-    kodi_send("ActivateWindow(ShutDownMenu)")
+def open_shutdown_menu(config: Config) -> None:
+    if config.kodi.jsonrpc_url is None:
+        kodi_send("ActivateWindow(ShutDownMenu)")
+        return
+
+    kodi_jsonrpc("GUI.ActivateWindow", {"window": "shutdownmenu"}, url=config.kodi.jsonrpc_url)
@@ -11,4 +11,9 @@ def configure_logging(stdout_level: str = "INFO") -> None:
         colorize=True,
         level=stdout_level,
         format="[{thread.name}] {time:YYYY-MM-DD HH:mm:ss} <level>{level}</level> {message}",
+        # The messages are written to stdout by a background thread, so the observer and worker threads
+        # never wait for the terminal (or journald) to keep up
+        enqueue=True,
+        backtrace=False,
+        diagnose=False,
     )
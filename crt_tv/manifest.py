@@ -0,0 +1,86 @@
+import hashlib
+import json
+import pathlib
+
+from loguru import logger
+
+from crt_tv.config import Config
+
+MANIFEST_FILENAME = ".crt-tv-manifest.json"
+
+# Only the settings which affect the contents of the output files, the ones which only change how fast they are
+# generated (e.g. the batch sizes, the resize backend or the JPEG encoder) are left out so that changing them
+# doesn't regenerate the whole library
+OUTPUT_SETTINGS = {"aspect_ratio", "resize_method", "ocr_backend", "ocr_page_segmentation_mode"}
+IMAGES_OUTPUT_SETTINGS = {"resample", "reducing_gap", "max_size", "jpeg_quality"}
+# The preset and copy_unchanged_video are mostly about the encoding speed but they change the video stream as well
+VIDEOS_OUTPUT_SETTINGS = {"video_codec", "preset", "audio_codec", "copy_unchanged_video"}
+TIMESTAMP_OUTPUT_SETTINGS = {
+    "position",
+    "date_format",
+    "full_format",
+    "fg_color",
+    "bg_color",
+    "margin_left",
+    "margin_right",
+    "margin_top",
+    "margin_bottom",
+    "padding_left",
+    "padding_right",
+    "padding_top",
+    "padding_bottom",
+    "font_names",
+    "font_size",
+    # The settings below change which timestamp is extracted (if any)
+    "detect_region",
+    "detect_height",
+    "detect_threshold",
+    "detect_min_stddev",
+    "use_exif",
+    "max_attempts",
+}
+
+
+def get_manifest_path(config: Config) -> pathlib.Path:
+    return config.output_files_dir / MANIFEST_FILENAME
+
+
+def get_settings_fingerprint(config: Config) -> str:
+    # Changing any of the settings which affect the contents of the output files invalidates all the
+    # previously processed files
+    settings = {
+        **config.model_dump(mode="json", include=OUTPUT_SETTINGS),
+        "images": {
+            **config.images.model_dump(mode="json", include=IMAGES_OUTPUT_SETTINGS),
+            "timestamp": config.images.timestamp.model_dump(mode="json", include=TIMESTAMP_OUTPUT_SETTINGS),
+        },
+        "videos": {
+            **config.videos.model_dump(mode="json", include=VIDEOS_OUTPUT_SETTINGS),
+            "timestamp": config.videos.timestamp.model_dump(mode="json", include=TIMESTAMP_OUTPUT_SETTINGS),
+        },
+    }
+
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+def is_manifest_up_to_date(config: Config) -> bool:
+    manifest_path = get_manifest_path(config)
+
+    try:
+        manifest = json.loads(manifest_path.read_text())
+    except FileNotFoundError:
+        logger.debug(f"No manifest found at {manifest_path}")
+        return False
+    except (OSError, ValueError):
+        logger.opt(exception=True).warning(f"Unable to read the manifest at {manifest_path}")
+        return False
+
+    return manifest.get("settings_fingerprint") == get_settings_fingerprint(config)
+
+
+def write_manifest(config: Config) -> None:
+    manifest_path = get_manifest_path(config)
+
+    logger.debug(f"Writing manifest to {manifest_path}")
+
+    manifest_path.write_text(json.dumps({"settings_fingerprint": get_settings_fingerprint(config)}, indent=2))
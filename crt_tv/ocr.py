@@ -0,0 +1,233 @@
+import pathlib
+import tempfile
+import threading
+from typing import TYPE_CHECKING
+
+import pytesseract
+from loguru import logger
+from PIL import ImageStat
+from PIL.Image import Image, Resampling
+
+from crt_tv.config import Config, TimestampConfig
+from crt_tv.ocr_cache import cache_texts, get_cached_texts, get_image_hash
+from crt_tv.profiling import measure_stage
+
+if TYPE_CHECKING:
+    import tesserocr
+
+# Tesseract terminates the text it extracts from each page (i.e. each input image) with a form feed
+TESSERACT_PAGE_SEPARATOR = "\f"
+
+# The timestamps are only digits and punctuation, so there's no point in loading the word dictionaries
+# (which also saves some of the initialisation time of each Tesseract run) or in considering any
+# other characters when classifying them (the spaces between the words don't need to be listed)
+TESSERACT_VARIABLES = {
+    "load_system_dawg": "0",
+    "load_freq_dawg": "0",
+    "tessedit_char_whitelist": "0123456789/:",
+}
+TESSERACT_CONFIG = " ".join(f"-c {name}={value}" for name, value in TESSERACT_VARIABLES.items())
+
+# The tesserocr API objects are not thread safe, so each thread gets its own one
+_tesserocr_thread_local = threading.local()
+
+
+def image_to_text(img: Image, config: Config, timestamp_config: TimestampConfig) -> str:
+    return images_to_text([img], config, timestamp_config)[0]
+
+
+def images_to_text(imgs: list[Image], config: Config, timestamp_config: TimestampConfig) -> list[str]:
+    # The timestamp config is either the images' or the videos' one, depending on where the regions were cut from
+    imgs = [_preprocess_image(img, timestamp_config) for img in imgs]
+
+    # There's no text to extract from a blank region, which saves a (comparatively slow) OCR run on it
+    extracted_texts = [""] * len(imgs)
+    ocr_indices = [index for index, img in enumerate(imgs) if not _is_blank_image(img, timestamp_config)]
+
+    if ocr_indices:
+        ocr_texts = _images_to_text_cached([imgs[index] for index in ocr_indices], config, timestamp_config)
+
+        for index, extracted_text in zip(ocr_indices, ocr_texts, strict=True):
+            extracted_texts[index] = extracted_text
+
+    return extracted_texts
+
+
+def _images_to_text_cached(imgs: list[Image], config: Config, timestamp_config: TimestampConfig) -> list[str]:
+    if not config.ocr_cache:
+        return _images_to_text_uncached(imgs, config, timestamp_config)
+
+    # The same images are processed again every time the source directory is reprocessed (or the file
+    # system observer gets a modified event), hashing the small timestamp region is a lot cheaper than OCR
+    tesseract_config = _get_tesseract_config(config)
+    image_hashes = [get_image_hash(img, config, extra_key=tesseract_config) for img in imgs]
+    texts_by_image_hash = get_cached_texts(image_hashes, config)
+
+    uncached_indices = [index for index, image_hash in enumerate(image_hashes) if image_hash not in texts_by_image_hash]
+
+    if uncached_indices:
+        logger.debug(f"{len(imgs) - len(uncached_indices)}/{len(imgs)} texts found in the OCR cache")
+
+        extracted_texts = _images_to_text_uncached(
+            [imgs[index] for index in uncached_indices], config, timestamp_config
+        )
+        new_texts_by_image_hash = {
+            image_hashes[index]: extracted_text
+            for index, extracted_text in zip(uncached_indices, extracted_texts, strict=True)
+        }
+
+        cache_texts(new_texts_by_image_hash, config)
+        texts_by_image_hash.update(new_texts_by_image_hash)
+
+    return [texts_by_image_hash[image_hash] for image_hash in image_hashes]
+
+
+def _images_to_text_uncached(imgs: list[Image], config: Config, timestamp_config: TimestampConfig) -> list[str]:
+    with measure_stage("ocr"):
+        if config.ocr_backend == "tesserocr":
+            return [_image_to_text_with_tesserocr(img, config) for img in imgs]
+
+        if len(imgs) == 1:
+            return [
+                pytesseract.image_to_string(
+                    imgs[0],
+                    config=_get_tesseract_config(config),
+                    timeout=timestamp_config.detect_timeout_seconds,
+                )
+            ]
+
+        return _images_to_text_with_pytesseract(imgs, config, timestamp_config)
+
+
+def _images_to_text_with_pytesseract(
+    imgs: list[Image],
+    config: Config,
+    timestamp_config: TimestampConfig,
+) -> list[str]:
+    # Tesseract accepts a text file listing the images to process as its input, processing all of them
+    # in a single run means its (rather expensive) initialisation is paid once rather than per image.
+    # NOTE: Keeping a single `tesseract stdin stdout` process running isn't an option since it reads
+    # only one image from stdin (until EOF) and exits, use the tesserocr backend to avoid the runs altogether
+    with tempfile.TemporaryDirectory(prefix="crt_tv_ocr_") as tmp_dir_name:
+        tmp_dir = pathlib.Path(tmp_dir_name)
+        image_paths: list[pathlib.Path] = []
+
+        for index, img in enumerate(imgs):
+            image_path = tmp_dir / f"{index}.png"
+            img.save(image_path)
+            image_paths.append(image_path)
+
+        list_file_path = tmp_dir / "images.txt"
+        list_file_path.write_text("".join(f"{image_path}\n" for image_path in image_paths))
+
+        extracted_text = pytesseract.image_to_string(
+            str(list_file_path),
+            config=_get_tesseract_config(config),
+            timeout=timestamp_config.detect_timeout_seconds * len(imgs),
+        )
+
+    extracted_texts = extracted_text.split(TESSERACT_PAGE_SEPARATOR)
+
+    if len(extracted_texts) < len(imgs):
+        raise RuntimeError(f"Expected Tesseract to extract text from {len(imgs)} images, got {len(extracted_texts)}")
+
+    return extracted_texts[: len(imgs)]
+
+
+def _preprocess_image(img: Image, timestamp_config: TimestampConfig) -> Image:
+    detect_height = timestamp_config.detect_height
+    threshold = timestamp_config.detect_threshold
+
+    # Tesseract's run time is roughly proportional to the number of pixels in the image
+    if detect_height is not None and img.height > detect_height:
+        img = img.resize((max(1, img.width * detect_height // img.height), detect_height), resample=Resampling.LANCZOS)
+
+    if threshold is not None:
+        img = img.convert("L")
+
+        if threshold == "otsu":
+            threshold = _get_otsu_threshold(img)
+
+        # Image.point() with a lookup table is applied by Pillow in C, there's no need for a per-pixel loop in Python.
+        # The result is stored as a 1-bit image which is an eighth of the data to hash and to write for Tesseract
+        img = img.point([255 if value > threshold else 0 for value in range(256)], mode="1")
+
+    return img
+
+
+def _is_blank_image(img: Image, timestamp_config: TimestampConfig) -> bool:
+    min_stddev = timestamp_config.detect_min_stddev
+
+    if min_stddev is None:
+        return False
+
+    # The statistics are computed from the histogram of the image, which Pillow does in C
+    return ImageStat.Stat(img.convert("L") if img.mode != "L" else img).stddev[0] < min_stddev
+
+
+def _get_otsu_threshold(img: Image) -> int:
+    # Otsu's method picks the threshold which maximises the variance between the two classes of pixels,
+    # it only needs the (256 bins) histogram of the grayscale image which Pillow computes in C
+    histogram = img.histogram()
+    total_count = sum(histogram)
+    total_sum = sum(value * count for value, count in enumerate(histogram))
+
+    background_count = 0
+    background_sum = 0
+    best_threshold = 0
+    best_variance = 0.0
+
+    for value, count in enumerate(histogram):
+        background_count += count
+        foreground_count = total_count - background_count
+
+        if background_count == 0:
+            continue
+
+        if foreground_count == 0:
+            break
+
+        background_sum += value * count
+        background_mean = background_sum / background_count
+        foreground_mean = (total_sum - background_sum) / foreground_count
+        variance = background_count * foreground_count * (background_mean - foreground_mean) ** 2
+
+        if variance > best_variance:
+            best_threshold = value
+            best_variance = variance
+
+    return best_threshold
+
+
+def _get_tesseract_config(config: Config) -> str:
+    if config.ocr_page_segmentation_mode is None:
+        return TESSERACT_CONFIG
+
+    return f"{TESSERACT_CONFIG} --psm {config.ocr_page_segmentation_mode}"
+
+
+def _get_tesserocr_api(config: Config) -> "tesserocr.PyTessBaseAPI":
+    # Imported lazily since tesserocr is an optional dependency
+    import tesserocr
+
+    api = getattr(_tesserocr_thread_local, "api", None)
+    psm = tesserocr.PSM.AUTO if config.ocr_page_segmentation_mode is None else config.ocr_page_segmentation_mode
+
+    if api is None:
+        # The API object keeps the language model loaded so it is only initialised once per thread
+        api = tesserocr.PyTessBaseAPI(lang="eng", psm=psm, variables=TESSERACT_VARIABLES)
+        _tesserocr_thread_local.api = api
+        _tesserocr_thread_local.psm = psm
+    elif _tesserocr_thread_local.psm != psm:
+        # The config may have been reloaded (by the file system observer) with a different page segmentation mode
+        api.SetPageSegMode(psm)
+        _tesserocr_thread_local.psm = psm
+
+    return api
+
+
+def _image_to_text_with_tesserocr(img: Image, config: Config) -> str:
+    api = _get_tesserocr_api(config)
+    api.SetImage(img)
+
+    return api.GetUTF8Text()
@@ -0,0 +1,74 @@
+import hashlib
+import os
+import pathlib
+import sqlite3
+import threading
+
+from loguru import logger
+from PIL.Image import Image
+
+from crt_tv.config import Config
+
+OCR_CACHE_FILENAME = ".ocr_cache.db"
+
+# Each process opens its own connection, it is shared between the threads of the image pipeline (and the
+# observer's workers) so it's only opened and used while holding the lock
+_connection: sqlite3.Connection | None = None
+_connection_key: tuple[int, pathlib.Path] | None = None
+_connection_lock = threading.Lock()
+
+
+def get_image_hash(img: Image, config: Config, *, extra_key: str = "") -> str:
+    image_hash = hashlib.blake2b(digest_size=16)
+    image_hash.update(f"{config.ocr_backend}:{extra_key}:{img.mode}:{img.width}x{img.height}:".encode())
+    image_hash.update(img.tobytes())
+
+    return image_hash.hexdigest()
+
+
+def get_cached_texts(image_hashes: list[str], config: Config) -> dict[str, str]:
+    placeholders = ", ".join("?" for _ in image_hashes)
+
+    try:
+        with _connection_lock:
+            rows = _get_connection(config).execute(
+                f"SELECT image_hash, text FROM ocr_texts WHERE image_hash IN ({placeholders})",
+                image_hashes,
+            )
+
+            return dict(rows.fetchall())
+    except sqlite3.Error:
+        logger.opt(exception=True).warning("Unable to read from the OCR cache, extracting the text of all images")
+        return {}
+
+
+def cache_texts(texts_by_image_hash: dict[str, str], config: Config) -> None:
+    try:
+        with _connection_lock:
+            _get_connection(config).executemany(
+                "INSERT OR REPLACE INTO ocr_texts (image_hash, text) VALUES (?, ?)",
+                texts_by_image_hash.items(),
+            )
+    except sqlite3.Error:
+        logger.opt(exception=True).warning("Unable to write to the OCR cache")
+
+
+def _get_connection(config: Config) -> sqlite3.Connection:
+    # NOTE: Must be called while holding _connection_lock, the connection is (re)opened here
+    global _connection, _connection_key
+
+    db_path = config.output_files_dir / OCR_CACHE_FILENAME
+    # A connection inherited from the parent process when forking the workers must not be reused
+    connection_key = (os.getpid(), db_path)
+
+    if _connection is None or _connection_key != connection_key:
+        logger.debug(f"Opening the OCR cache at {db_path}")
+
+        # Several worker processes write to the cache at the same time, WAL mode lets them
+        # do so without blocking the readers and the timeout makes the writers wait for each other
+        _connection = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        _connection.execute("PRAGMA journal_mode=WAL")
+        _connection.execute("CREATE TABLE IF NOT EXISTS ocr_texts (image_hash TEXT PRIMARY KEY, text TEXT NOT NULL)")
+        _connection_key = connection_key
+
+    return _connection
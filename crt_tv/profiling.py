@@ -0,0 +1,85 @@
+import contextlib
+import os
+import pathlib
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from collections import Counter
+from collections.abc import Iterator
+
+from loguru import logger
+
+# Total time spent in each processing stage (decode, resize, ocr, encode) by this process, the
+# stages of the image pipeline run in separate threads so the counter is guarded by a lock
+_stage_durations_ns: Counter[str] = Counter()
+_stage_durations_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def measure_stage(stage: str) -> Iterator[None]:
+    start_ns = time.perf_counter_ns()
+
+    try:
+        yield
+    finally:
+        duration_ns = time.perf_counter_ns() - start_ns
+
+        with _stage_durations_lock:
+            _stage_durations_ns[stage] += duration_ns
+
+
+def add_stage_durations(stage_durations_ns: Counter[str]) -> None:
+    with _stage_durations_lock:
+        _stage_durations_ns.update(stage_durations_ns)
+
+
+def pop_stage_durations() -> Counter[str]:
+    with _stage_durations_lock:
+        stage_durations_ns = _stage_durations_ns.copy()
+        _stage_durations_ns.clear()
+
+    return stage_durations_ns
+
+
+def format_stage_durations(stage_durations_ns: Counter[str]) -> str:
+    if not stage_durations_ns:
+        return "no stages were measured"
+
+    return ", ".join(
+        f"{stage}: {duration_ns / 1_000_000_000:.2f}s" for stage, duration_ns in stage_durations_ns.most_common()
+    )
+
+
+def start_profiler(output_path: pathlib.Path) -> subprocess.Popen:
+    py_spy_binary = shutil.which("py-spy")
+
+    if py_spy_binary is None:
+        raise RuntimeError("py-spy is not installed, install it with `uv tool install py-spy`")
+
+    logger.info(f"Recording a py-spy profile to {output_path}")
+
+    return subprocess.Popen(
+        [
+            py_spy_binary,
+            "record",
+            "--native",
+            "--subprocesses",
+            "--pid",
+            str(os.getpid()),
+            "--output",
+            str(output_path),
+        ],
+    )
+
+
+def stop_profiler(profiler: subprocess.Popen) -> None:
+    # py-spy writes the recorded profile when it's interrupted
+    profiler.send_signal(signal.SIGINT)
+
+    try:
+        profiler.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        logger.warning("py-spy didn't exit in time, killing it")
+        profiler.kill()
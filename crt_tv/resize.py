@@ -1,23 +1,43 @@
+import functools
 from typing import Literal
 
 from crt_tv.config import ASPECT_RATIO_REGEX
 
 
+# There's usually a single aspect ratio (from the config) for the whole lifetime of the process
+@functools.lru_cache(maxsize=16)
+def parse_aspect_ratio(aspect_ratio: str) -> float:
+    aspect_ratio_match = ASPECT_RATIO_REGEX.match(aspect_ratio)
+
+    if not aspect_ratio_match:
+        raise ValueError(f"Invalid aspect ratio '{aspect_ratio}', must be in the form 'width:height'")
+
+    aspect_ratio_width = int(aspect_ratio_match.group("width"))
+    aspect_ratio_height = int(aspect_ratio_match.group("height"))
+
+    return aspect_ratio_width / aspect_ratio_height
+
+
 def get_new_dimensions(
     orig_width: int,
     orig_height: int,
     new_aspect_ratio: str,
     resize_method: Literal["stretch", "crop"],
 ) -> tuple[int, int]:
-    aspect_ratio_match = ASPECT_RATIO_REGEX.match(new_aspect_ratio)
+    return get_new_dimensions_for_aspect_ratio(
+        orig_width,
+        orig_height,
+        parse_aspect_ratio(new_aspect_ratio),
+        resize_method=resize_method,
+    )
 
-    if not aspect_ratio_match:
-        raise ValueError(f"Invalid aspect ratio '{new_aspect_ratio}', must be in the form 'width:height'")
-
-    aspect_ratio_width = int(aspect_ratio_match.group("width"))
-    aspect_ratio_height = int(aspect_ratio_match.group("height"))
-    aspect_ratio = aspect_ratio_width / aspect_ratio_height
 
+def get_new_dimensions_for_aspect_ratio(
+    orig_width: int,
+    orig_height: int,
+    aspect_ratio: float,
+    resize_method: Literal["stretch", "crop"],
+) -> tuple[int, int]:
     if resize_method == "stretch":
         new_width = orig_width
         new_height = int(orig_width / aspect_ratio)
@@ -1,15 +1,20 @@
+import contextlib
 import datetime
+import functools
 import pathlib
 import re
+from collections.abc import Callable, Iterator
+from typing import Any
 
 import moviepy.editor as mp
-import pytesseract
 from loguru import logger
 from PIL.Image import Image
 from PIL.Image import fromarray as image_fromarray
+from PIL.Image import open as image_open
 from PIL.ImageFont import FreeTypeFont, truetype
 
 from crt_tv.config import Config
+from crt_tv.ocr import image_to_text, images_to_text
 
 # The timestamp from the image, e.g. 2024/11/06 19:49:09
 # Sometimes only part of it is visivle against the background, in which case
@@ -33,25 +38,90 @@ TIMESTAMP_PARSE_REGEX = re.compile(
     re.VERBOSE,
 )
 
+# The EXIF sub-IFD and the tag in it with the time the photo was taken
+# ref: https://exiftool.org/TagNames/EXIF.html
+EXIF_IFD_TAG = 0x8769
+EXIF_DATE_TIME_ORIGINAL_TAG = 0x9003
+EXIF_DATE_TIME_FORMAT = "%Y:%m:%d %H:%M:%S"
 
-def parse_timestamp_from_image(
-    img: Image,
+# When reading the video frames with OpenCV, frames up to this far ahead are grabbed one by one instead
+# of seeking to them (the same as MoviePy does when reading the frames with ffmpeg)
+MAX_VIDEO_FRAMES_TO_GRAB = 100
+
+
+def crop_timestamp_region(img: Image, region_size: tuple[int, int]) -> Image:
+    logger.debug("Cutting the bottom left corner of the image to extract the timestamp")
+
+    region_width, region_height = region_size
+    img_height = img.height
+    timestamp_region = img.crop((0, max(0, img_height - region_height), min(region_width, img.width), img_height))
+
+    # Tesseract works on grayscale images anyway, converting the (small) region here means a third of
+    # the data is written to its input file and it doesn't have to do the conversion itself
+    if timestamp_region.mode != "L":
+        timestamp_region = timestamp_region.convert("L")
+
+    return timestamp_region
+
+
+def read_timestamp_region(image_path: pathlib.Path, config: Config) -> Image:
+    with image_open(image_path) as img:
+        # The timestamp is extracted from a grayscale image anyway, so let the JPEG decoder skip
+        # the chroma channels and the colour conversion when decoding the image
+        img.draft("L", img.size)
+
+        return crop_timestamp_region(img, config.images.timestamp.detect_region)
+
+
+def crop_timestamp_region_from_frame(frame: Any, region_size: tuple[int, int]) -> Image:
+    logger.debug("Cutting the bottom left corner of the video frame to extract the timestamp")
+
+    region_width, region_height = region_size
+
+    # Slicing the frame is just a view of the array, so only the timestamp region is copied into the
+    # image rather than building an image of the whole frame only to crop it
+    return image_fromarray(frame[-region_height:, :region_width]).convert("L")
+
+
+def read_exif_timestamp(img: Image) -> datetime.datetime | None:
+    # The EXIF data of a JPEG is read along with its header, so there's no extra decoding involved
+    date_time_original = img.getexif().get_ifd(EXIF_IFD_TAG).get(EXIF_DATE_TIME_ORIGINAL_TAG)
+
+    if not isinstance(date_time_original, str):
+        return None
+
+    try:
+        return datetime.datetime.strptime(date_time_original.strip("\x00 "), EXIF_DATE_TIME_FORMAT)
+    except ValueError:
+        logger.debug(f"Invalid DateTimeOriginal EXIF tag: '{date_time_original}'")
+        return None
+
+
+def parse_timestamp_from_region(
+    timestamp_region: Image,
     config: Config,
     *,
     failed_timestamp_filename: str,
 ) -> datetime.datetime | datetime.date:
-    logger.debug("Cutting the bottom left corner of the image to extract the timestamp")
-
-    img_width, img_height = img.size
-    # TODO: Extract the magic numbers these into config options
-    timestamp_region = img.crop((0, img_height - 100, 1000, img_height))
-
     logger.debug("Extracting all text from from the cut part of the image")
 
-    extracted_text = pytesseract.image_to_string(
-        timestamp_region, timeout=config.images.timestamp.detect_timeout_seconds
+    extracted_text = image_to_text(timestamp_region, config, config.images.timestamp)
+
+    return parse_timestamp_from_text(
+        extracted_text,
+        config,
+        timestamp_region=timestamp_region,
+        failed_timestamp_filename=failed_timestamp_filename,
     )
 
+
+def parse_timestamp_from_text(
+    extracted_text: str,
+    config: Config,
+    *,
+    timestamp_region: Image,
+    failed_timestamp_filename: str,
+) -> datetime.datetime | datetime.date:
     logger.debug(f"Extracted text: '{extracted_text}'")
 
     match = TIMESTAMP_PARSE_REGEX.search(extracted_text)
@@ -66,7 +136,7 @@ def parse_timestamp_from_image(
 
         failed_timestamp_extracts_dir.mkdir(parents=True, exist_ok=True)
 
-        timestamp_region.save(timestamp_path.resolve())
+        timestamp_region.save(timestamp_path)
 
         logger.info(f"Saved cut part of the image to {relative_timestamp_path}")
 
@@ -110,37 +180,71 @@ def parse_timestamp_from_video(
 
     best_timestamp: datetime.datetime | datetime.date | None = None
 
-    for attempt in range(0, total_attempts):
-        frame_number = min(int((total_frames // total_attempts) * attempt), total_frames)
-        frame_time = min(frame_number / video.fps, video.duration)
-
-        logger.debug(
-            f"Attempt {attempt + 1}/{total_attempts}: Extracting frame {frame_number} at time {frame_time:.2f}s"
-        )
-
-        img = image_fromarray(video.get_frame(frame_time))
-
-        try:
-            timestamp = parse_timestamp_from_image(
-                img,
-                config,
-                failed_timestamp_filename=f"{video_file_path.stem}_frame_{frame_number}.jpg",
-            )
-            logger.debug(f"Timestamp successfully extracted: {timestamp}")
-        except Exception:
-            logger.warning(f"Failed to extract timestamp from frame {frame_number}")
-            continue
-
-        # NOTE: It's important to check for datetime first since datetime is a subclass of date
-
-        if isinstance(timestamp, datetime.datetime):
-            best_timestamp = timestamp
-            logger.debug("Found a full datetime timestamp, stopping further attempts")
-            break
-
-        if isinstance(timestamp, datetime.date) and best_timestamp is not None:
-            best_timestamp = timestamp
-            logger.debug("Found a date-only timestamp, continuing to search for a full datetime")
+    # The first frame usually has a readable timestamp so it's OCR'd on its own, if it doesn't the regions of
+    # all the other frames are OCR'd together which means Tesseract is run once instead of for every attempt
+    attempts = list(range(0, total_attempts))
+
+    with _open_video_frame_reader(video, video_file_path, config) as read_frame:
+        for attempts_batch in (attempts[:1], attempts[1:]):
+            timestamp_regions: list[tuple[int, Image]] = []
+
+            for attempt in attempts_batch:
+                frame_number = min(int((total_frames // total_attempts) * attempt), total_frames)
+                frame_time = min(frame_number / video.fps, video.duration)
+
+                logger.debug(
+                    f"Attempt {attempt + 1}/{total_attempts}: Extracting frame {frame_number} at time {frame_time:.2f}s"
+                )
+
+                try:
+                    timestamp_region = crop_timestamp_region_from_frame(
+                        read_frame(frame_number, frame_time), config.videos.timestamp.detect_region
+                    )
+                except Exception:
+                    logger.warning(f"Failed to read frame {frame_number}")
+                    continue
+
+                timestamp_regions.append((frame_number, timestamp_region))
+
+            if not timestamp_regions:
+                continue
+
+            try:
+                extracted_texts = images_to_text(
+                    [timestamp_region for _, timestamp_region in timestamp_regions], config, config.videos.timestamp
+                )
+            except Exception:
+                logger.warning(f"Failed to extract the text from frames {[number for number, _ in timestamp_regions]}")
+                continue
+
+            for (frame_number, timestamp_region), extracted_text in zip(
+                timestamp_regions, extracted_texts, strict=True
+            ):
+                try:
+                    timestamp = parse_timestamp_from_text(
+                        extracted_text,
+                        config,
+                        timestamp_region=timestamp_region,
+                        failed_timestamp_filename=f"{video_file_path.stem}_frame_{frame_number}.jpg",
+                    )
+                    logger.debug(f"Timestamp successfully extracted: {timestamp}")
+                except Exception:
+                    logger.warning(f"Failed to extract timestamp from frame {frame_number}")
+                    continue
+
+                # NOTE: It's important to check for datetime first since datetime is a subclass of date
+
+                if isinstance(timestamp, datetime.datetime):
+                    best_timestamp = timestamp
+                    logger.debug("Found a full datetime timestamp, stopping further attempts")
+                    break
+
+                if isinstance(timestamp, datetime.date) and best_timestamp is not None:
+                    best_timestamp = timestamp
+                    logger.debug("Found a date-only timestamp, continuing to search for a full datetime")
+
+            if isinstance(best_timestamp, datetime.datetime):
+                break
 
     if best_timestamp is None:
         raise ValueError(f"No timestamp found in the video after {total_attempts} attempts")
@@ -149,12 +253,62 @@ def parse_timestamp_from_video(
     return best_timestamp
 
 
+@contextlib.contextmanager
+def _open_video_frame_reader(
+    video: mp.VideoFileClip,
+    video_file_path: pathlib.Path,
+    config: Config,
+) -> Iterator[Callable[[int, float], Any]]:
+    # The returned function takes the frame number and time of the frame and returns it as an RGB array
+    if config.videos.timestamp.frame_reader == "moviepy":
+        yield lambda frame_number, frame_time: video.get_frame(frame_time)
+        return
+
+    # Imported lazily since opencv is an optional dependency
+    import cv2
+
+    capture = cv2.VideoCapture(str(video_file_path))
+
+    if not capture.isOpened():
+        raise ValueError(f"OpenCV couldn't open {video_file_path.name}")
+
+    next_frame_number = 0
+
+    def read_frame_with_opencv(frame_number: int, frame_time: float) -> Any:
+        nonlocal next_frame_number
+
+        if 0 <= frame_number - next_frame_number <= MAX_VIDEO_FRAMES_TO_GRAB:
+            # The frames are sampled in order, when the next one is close grabbing the frames in between
+            # is cheaper than seeking since they are not converted (and the decoder isn't flushed)
+            for _ in range(frame_number - next_frame_number):
+                capture.grab()
+        else:
+            # Seeking goes to the closest keyframe and only decodes the frames from there, rather than
+            # reading every frame up to the requested one
+            capture.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+
+        success, frame = capture.read()
+
+        if not success:
+            raise ValueError(f"OpenCV couldn't read frame {frame_number} of {video_file_path.name}")
+
+        next_frame_number = frame_number + 1
+
+        # OpenCV decodes the frames as BGR, reversing the channels is just a view of the array
+        return frame[:, :, ::-1]
+
+    try:
+        yield read_frame_with_opencv
+    finally:
+        capture.release()
+
+
 def get_images_timestamp_font(config: Config) -> FreeTypeFont:
     logger.info("Searching for timestamp font")
 
     for font_name in config.images.timestamp.font_names:
         try:
-            font = truetype(font_name, config.images.timestamp.font_size)
+            font = _load_font(font_name, config.images.timestamp.font_size)
         except OSError:
             logger.warning(f"Font '{font_name}' not found, trying next font")
         else:
@@ -162,3 +316,9 @@ def get_images_timestamp_font(config: Config) -> FreeTypeFont:
             return font
 
     raise OSError(f"None of the fonts {config.images.timestamp.font_names} were found")
+
+
+@functools.lru_cache(maxsize=8)
+def _load_font(font_name: str | pathlib.Path, font_size: int) -> FreeTypeFont:
+    # Searching for and parsing the font file is only done once per process for every font & size
+    return truetype(font_name, font_size)
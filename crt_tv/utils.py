@@ -1,14 +1,95 @@
+import functools
+import os
 import pathlib
+from collections.abc import Iterator
 
 from crt_tv.config import Config
 
+# Output directories which were already created by this process, so creating them is only attempted once
+_created_output_dirs: set[str] = set()
 
-def get_output_path(source_path: pathlib.Path, config: Config) -> pathlib.Path:
-    dest_suffix = ".mp4" if source_path.suffix.lower() == ".avi" else source_path.suffix
 
-    relative_source_path = source_path.relative_to(config.source_files_dir)
+def get_output_path(source_path: pathlib.Path, config: Config, *, create_parent_dir: bool = True) -> pathlib.Path:
+    output_path = _get_output_path_str(
+        os.fspath(source_path),
+        os.fspath(config.source_files_dir),
+        os.fspath(config.output_files_dir),
+    )
 
-    output_path = config.output_files_dir / relative_source_path.with_suffix(dest_suffix)
-    output_path.parent.mkdir(parents=True, exist_ok=True)
+    if create_parent_dir:
+        output_dir = os.path.dirname(output_path)  # noqa: PTH120
 
-    return output_path
+        if output_dir not in _created_output_dirs:
+            os.makedirs(output_dir, exist_ok=True)  # noqa: PTH103
+            _created_output_dirs.add(output_dir)
+
+    return pathlib.Path(output_path)
+
+
+@functools.lru_cache(maxsize=4096)
+def _get_output_path_str(source_path: str, source_files_dir: str, output_files_dir: str) -> str:
+    # This is called (often several times) for every processed file and fs event, so the path is built
+    # with plain string operations instead of Path.relative_to() & co which create several intermediate
+    # Path objects, only strings are passed in so that the result can be cached
+    source_files_dir_prefix = os.path.join(source_files_dir, "")  # noqa: PTH118
+
+    if not source_path.startswith(source_files_dir_prefix):
+        raise ValueError(f"{source_path} is not in the source files directory {source_files_dir}")
+
+    relative_source_path, source_suffix = os.path.splitext(source_path[len(source_files_dir_prefix) :])  # noqa: PTH122
+    dest_suffix = ".mp4" if source_suffix.lower() == ".avi" else source_suffix
+
+    return os.path.join(output_files_dir, relative_source_path + dest_suffix)  # noqa: PTH118
+
+
+def forget_created_output_dirs() -> None:
+    _created_output_dirs.clear()
+
+
+def is_output_up_to_date(source_path: pathlib.Path, config: Config, *, source_mtime_ns: int | None = None) -> bool:
+    # The mtime of the source file can be passed in when the caller has already stat()-ed it
+    output_path = get_output_path(source_path, config, create_parent_dir=False)
+
+    try:
+        if source_mtime_ns is None:
+            source_mtime_ns = source_path.stat().st_mtime_ns
+
+        return output_path.stat().st_mtime_ns >= source_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def prefetch_files(file_paths: list[pathlib.Path]) -> None:
+    # Ask the kernel to start reading the files in the background, so they are (hopefully)
+    # already in the page cache by the time they are decoded, posix_fadvise() is not available on macOS
+    if not hasattr(os, "posix_fadvise"):
+        return
+
+    for file_path in file_paths:
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+        except OSError:
+            continue
+
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+def iter_source_files(source_dir: pathlib.Path | str) -> Iterator[os.DirEntry[str]]:
+    # os.scandir() gets the file type of each entry for free while listing the directory,
+    # unlike Path.glob() which needs a separate stat() call and a Path object for every entry.
+    # The directories are walked with an explicit stack rather than recursively, so only one of
+    # them is open at a time and the entries aren't passed through a chain of nested generators
+    dirs_to_scan = [os.fspath(source_dir)]
+
+    while dirs_to_scan:
+        with os.scandir(dirs_to_scan.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs_to_scan.append(entry.path)
+                elif entry.is_file() and not entry.name.startswith("."):
+                    yield entry
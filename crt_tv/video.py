@@ -1,9 +1,12 @@
 import datetime
 import pathlib
+import subprocess
+import tempfile
 
 import moviepy.editor as mp
 import moviepy.video.fx.all as vfx
 from loguru import logger
+from moviepy.config import get_setting
 
 from crt_tv.config import Config
 from crt_tv.resize import get_new_dimensions
@@ -15,7 +18,7 @@ def process_single_video(
     video_path: pathlib.Path,
     config: Config,
 ) -> pathlib.Path:
-    with mp.VideoFileClip(str(video_path.resolve())) as video:
+    with mp.VideoFileClip(str(video_path)) as video:
         timestamp_text_clip = None
 
         try:
@@ -50,16 +53,22 @@ def process_single_video(
             resize_method=config.resize_method,
         )
 
+        if (
+            config.videos.copy_unchanged_video
+            and timestamp_text_clip is None
+            and (new_width, new_height) == (orig_width, orig_height)
+        ):
+            dest_path = get_output_path(video_path, config)
+
+            if _copy_video_stream(video_path, dest_path, config):
+                logger.info(f"Video {video_path.name} is unchanged, copied its video stream to {dest_path}")
+                return dest_path
+
         crop_x = (orig_width - new_width) // 2 if orig_width != new_width else 0
         crop_y = (orig_height - new_height) // 2 if orig_height != new_height else 0
 
-        resized_video = vfx.crop(
-            video,
-            x1=crop_x,
-            y1=crop_y,
-            width=new_width,
-            height=new_height,
-        )
+        timestamp_tile_clip = None
+        bg_rect_x = bg_rect_y = 0
 
         if timestamp_text_clip is not None:
             timestamp_text_width, timestamp_text_height = timestamp_text_clip.size
@@ -93,24 +102,136 @@ def process_single_video(
 
             bg_rect_x = timestamp_x + config.videos.timestamp.margin_left - config.videos.timestamp.margin_right
             bg_rect_y = timestamp_y + config.videos.timestamp.margin_top - config.videos.timestamp.margin_bottom
-            timestamp_text_x = bg_rect_x + config.videos.timestamp.padding_left
-            timestamp_text_y = bg_rect_y + config.videos.timestamp.padding_top
 
-            resized_video = mp.CompositeVideoClip(
+            # The timestamp doesn't change throughout the video, so the text on its background is composed once
+            timestamp_tile_clip = mp.CompositeVideoClip(
                 [
-                    resized_video,
-                    bg_rect_clip.set_duration(video.duration).set_pos((bg_rect_x, bg_rect_y)),
-                    timestamp_text_clip.set_duration(video.duration).set_pos((timestamp_text_x, timestamp_text_y)),
-                ]
+                    bg_rect_clip,
+                    timestamp_text_clip.set_pos(
+                        (config.videos.timestamp.padding_left, config.videos.timestamp.padding_top)
+                    ),
+                ],
+                size=(bg_rect_width, bg_rect_height),
             )
+
         dest_path = get_output_path(video_path, config)
 
-        resized_video.write_videofile(
-            str(dest_path.resolve()),
-            codec=config.videos.video_codec,
-            audio_codec=config.videos.audio_codec,
-        )
+        if not _write_video_with_ffmpeg(
+            video_path,
+            dest_path,
+            config,
+            crop_box=(crop_x, crop_y, new_width, new_height),
+            timestamp_tile_clip=timestamp_tile_clip,
+            timestamp_tile_position=(bg_rect_x, bg_rect_y),
+        ):
+            resized_video = vfx.crop(
+                video,
+                x1=crop_x,
+                y1=crop_y,
+                width=new_width,
+                height=new_height,
+            )
+
+            if timestamp_tile_clip is not None:
+                resized_video = mp.CompositeVideoClip(
+                    [
+                        resized_video,
+                        timestamp_tile_clip.set_duration(video.duration).set_pos((bg_rect_x, bg_rect_y)),
+                    ]
+                )
 
-    logger.info(f"Processed video {video_path.name} to {dest_path.resolve()} with size {new_width}x{new_height}")
+            resized_video.write_videofile(
+                str(dest_path),
+                codec=config.videos.video_codec,
+                preset=config.videos.preset,
+                audio_codec=config.videos.audio_codec,
+            )
+
+    logger.info(f"Processed video {video_path.name} to {dest_path} with size {new_width}x{new_height}")
 
     return dest_path
+
+
+def _copy_video_stream(video_path: pathlib.Path, dest_path: pathlib.Path, config: Config) -> bool:
+    # Remuxing the video stream is only bound by the disk speed, unlike the re-encode done by MoviePy
+    result = subprocess.run(
+        [
+            get_setting("FFMPEG_BINARY"),
+            "-loglevel",
+            "error",
+            "-y",
+            "-i",
+            str(video_path),
+            "-c:v",
+            "copy",
+            "-c:a",
+            config.videos.audio_codec,
+            str(dest_path),
+        ],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+
+    if result.returncode != 0:
+        logger.warning(
+            f"Couldn't copy the video stream of {video_path.name}, re-encoding it instead: {result.stderr.strip()}"
+        )
+        return False
+
+    return True
+
+
+def _write_video_with_ffmpeg(
+    video_path: pathlib.Path,
+    dest_path: pathlib.Path,
+    config: Config,
+    *,
+    crop_box: tuple[int, int, int, int],
+    timestamp_tile_clip: mp.VideoClip | None,
+    timestamp_tile_position: tuple[int, int],
+) -> bool:
+    # Compositing the timestamp onto every frame in MoviePy means piping all the (raw) frames through Python,
+    # instead the timestamp is saved as an image once and ffmpeg does the crop and the overlay by itself
+    crop_x, crop_y, crop_width, crop_height = crop_box
+    crop_filter = f"crop={crop_width}:{crop_height}:{crop_x}:{crop_y}"
+
+    with tempfile.TemporaryDirectory(prefix="crt_tv_video_") as tmp_dir_name:
+        ffmpeg_args = ["-i", str(video_path)]
+
+        if timestamp_tile_clip is None:
+            ffmpeg_args += ["-vf", crop_filter]
+        else:
+            timestamp_tile_path = pathlib.Path(tmp_dir_name) / "timestamp.png"
+            timestamp_tile_clip.save_frame(str(timestamp_tile_path))
+
+            tile_x, tile_y = timestamp_tile_position
+            ffmpeg_args += [
+                "-i",
+                str(timestamp_tile_path),
+                "-filter_complex",
+                f"[0:v]{crop_filter}[cropped];[cropped][1:v]overlay={tile_x}:{tile_y}",
+            ]
+
+        ffmpeg_args += ["-c:v", config.videos.video_codec, "-preset", config.videos.preset]
+
+        # The same as MoviePy does, most players can only decode H.264 videos with 4:2:0 chroma subsampling
+        if config.videos.video_codec == "libx264" and crop_width % 2 == 0 and crop_height % 2 == 0:
+            ffmpeg_args += ["-pix_fmt", "yuv420p"]
+
+        ffmpeg_args += ["-c:a", config.videos.audio_codec]
+
+        result = subprocess.run(
+            [get_setting("FFMPEG_BINARY"), "-loglevel", "error", "-y", *ffmpeg_args, str(dest_path)],
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+
+    if result.returncode != 0:
+        logger.warning(
+            f"ffmpeg couldn't process {video_path.name}, processing it with MoviePy instead: {result.stderr.strip()}"
+        )
+        return False
+
+    return True
@@ -0,0 +1,101 @@
+import io
+import math
+import os
+import pathlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL.ImageFont import FreeTypeFont, truetype
+
+from crt_tv.config import Config
+from crt_tv.images import process_image_batches
+from crt_tv.profiling import pop_stage_durations
+from crt_tv.video import process_single_video
+
+MAX_BATCHES_PER_TASK = 4
+
+# Populated in each worker process by init_worker(), the font is loaded once per
+# worker instead of being sent along with every image since it can't be pickled
+_worker_config: Config | None = None
+_worker_timestamp_font: FreeTypeFont | None = None
+
+
+def init_worker(config: Config, timestamp_font_bytes: bytes) -> None:
+    global _worker_config, _worker_timestamp_font
+
+    _worker_config = config
+    _worker_timestamp_font = truetype(io.BytesIO(timestamp_font_bytes), config.images.timestamp.font_size)
+
+
+def process_image_batches_in_worker(
+    image_path_batches: list[list[pathlib.Path]],
+) -> tuple[list[pathlib.Path], Counter[str]]:
+    if _worker_config is None or _worker_timestamp_font is None:
+        raise RuntimeError("The worker process was not initialised, init_worker() must be called first")
+
+    output_image_paths = process_image_batches(image_path_batches, _worker_config, _worker_timestamp_font)
+
+    # The stage durations are measured in the worker, send them back so they can be reported by the main process
+    return output_image_paths, pop_stage_durations()
+
+
+def process_video_in_worker(video_path: pathlib.Path) -> tuple[list[pathlib.Path], Counter[str]]:
+    if _worker_config is None:
+        raise RuntimeError("The worker process was not initialised, init_worker() must be called first")
+
+    # Returned the same way as the images so both kinds of tasks can be waited on together
+    output_video_paths = [process_single_video(video_path, _worker_config)]
+
+    return output_video_paths, pop_stage_durations()
+
+
+def get_num_workers(config: Config) -> int:
+    if config.num_workers is not None:
+        return config.num_workers
+
+    # Leave a CPU to the main process (and to Kodi when running on the Pi)
+    return max(1, (os.cpu_count() or 1) - 1)
+
+
+def split_into_batches(image_paths: list[pathlib.Path], config: Config) -> list[list[pathlib.Path]]:
+    # Keep the batches small enough that every worker gets at least one of them
+    batch_size = min(
+        config.images.timestamp.detect_batch_size,
+        max(1, math.ceil(len(image_paths) / get_num_workers(config))),
+    )
+
+    return [image_paths[index : index + batch_size] for index in range(0, len(image_paths), batch_size)]
+
+
+def split_into_tasks(image_paths: list[pathlib.Path], config: Config) -> list[list[list[pathlib.Path]]]:
+    # Each task is a few batches which are pipelined inside the worker, but keep the tasks
+    # small enough that every worker gets at least one of them
+    image_path_batches = split_into_batches(image_paths, config)
+    batches_per_task = min(
+        MAX_BATCHES_PER_TASK,
+        max(1, math.ceil(len(image_path_batches) / get_num_workers(config))),
+    )
+
+    return [
+        image_path_batches[index : index + batches_per_task]
+        for index in range(0, len(image_path_batches), batches_per_task)
+    ]
+
+
+def create_process_pool(config: Config, timestamp_font: FreeTypeFont) -> ProcessPoolExecutor:
+    # Tesseract parallelises each call with OpenMP which only ends up oversubscribing the CPUs
+    # when several workers run it at the same time, so limit it to a single thread per process
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+    # The font has already been searched for in the main process, so only send its contents to the
+    # workers rather than having each of them go through the font names and read the file again
+    if not isinstance(timestamp_font.path, str | bytes | os.PathLike):
+        raise TypeError(f"The timestamp font must be loaded from a file, got {type(timestamp_font.path)}")
+
+    timestamp_font_bytes = pathlib.Path(os.fsdecode(timestamp_font.path)).read_bytes()
+
+    return ProcessPoolExecutor(
+        max_workers=get_num_workers(config),
+        initializer=init_worker,
+        initargs=(config, timestamp_font_bytes),
+    )
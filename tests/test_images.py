@@ -0,0 +1,38 @@
+import datetime
+import pathlib
+
+import pytest
+from PIL.Image import new as new_image
+
+from crt_tv.config import Config
+from crt_tv.images import draw_timestamp
+from crt_tv.timestamp import get_images_timestamp_font
+
+
+@pytest.fixture
+def config(tmp_path: pathlib.Path) -> Config:
+    source_files_dir = tmp_path / "source"
+    source_files_dir.mkdir()
+
+    return Config(
+        source_files_dir=source_files_dir,
+        output_files_dir=tmp_path / "output",
+        aspect_ratio="4:3",
+        resize_method="crop",
+    )
+
+
+@pytest.mark.parametrize("mode", ["RGB", "L"])
+def test_draw_timestamp(config: Config, mode: str) -> None:
+    img = new_image(mode, (1440, 1080), "gray")
+
+    draw_timestamp(
+        img,
+        datetime.datetime(2024, 11, 6, 19, 49, 9),
+        font=get_images_timestamp_font(config),
+        config=config,
+    )
+
+    # The timestamp is drawn in the bottom left corner, white text on a black background
+    timestamp_region = img.crop((0, img.height - 200, 1000, img.height))
+    assert timestamp_region.convert("L").getextrema() == (0, 255)